@@ -0,0 +1,59 @@
+"""
+Minimal stand-in for the R^3 model server, so benchmarks don't depend on a database
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from urllib.parse import urlparse
+
+
+def stub_model(model_id: str) -> dict:
+    # Every model is an ATBA checkpoint, but each id is loaded as a separate opponent
+    return {
+        "id": model_id,
+        "runName": "atba",
+        "botName": "atba",
+        "created": "1970-01-01T00:00:00",
+        "ts": {"mu": 25, "sigma": 25 / 3},
+        "steps": 0,
+        "location": {"type": "n/a", "value": "n/a"}
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/models/latest':
+            self._send({"error": "No models"}, 404)
+        elif path.startswith('/models/'):
+            self._send(stub_model(path[len('/models/'):]))
+        else:
+            self._send({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if urlparse(self.path).path == '/ts/opponents':
+            models = [stub_model(f'atba-{i}') for i in range(int(body["numOpponents"]))]
+            self._send(models if body.get("expand", False) else [m["id"] for m in models])
+        else:
+            self._send({"error": "Not found"}, 404)
+
+    def _send(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(port: int=0) -> ThreadingHTTPServer:
+    """
+    Starts the stub on a background thread. Port 0 picks a free port, see `server.server_port`.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,154 @@
+"""
+Measures env steps per second of plain RLGym against RCubed, to track the cost of the wrapper.
+
+Run from the repository root:
+    python -m benchmarks.throughput --output bench_output.json
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from itertools import chain, product
+import json
+import platform
+import random
+from statistics import median
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from rlgym.api import RLGym
+from rlgym.rocket_league.action_parsers import LookupTableAction, RepeatAction
+from rlgym.rocket_league.done_conditions import GoalCondition, AnyCondition, TimeoutCondition, NoTouchTimeoutCondition
+from rlgym.rocket_league.obs_builders import DefaultObs
+from rlgym.rocket_league.reward_functions import CombinedReward, GoalReward, TouchReward
+from rlgym.rocket_league.sim import RocketSimEngine
+from rlgym.rocket_league.state_mutators import MutatorSequence, FixedTeamSizeMutator, KickoffMutator
+
+from benchmarks.stub_server import start_stub_server
+from rcubed.premade import ATBA
+from rcubed.wrapper import RCubed
+
+
+def env_kwargs(team_size: int, repeats: int) -> Dict[str, Any]:
+    return dict(
+        state_mutator=MutatorSequence(
+            FixedTeamSizeMutator(blue_size=team_size, orange_size=team_size),
+            KickoffMutator()
+        ),
+        obs_builder=DefaultObs(zero_padding=None),
+        # Always wrapped, since opponent parsers (like ATBA's) expect the tick dimension it adds
+        action_parser=RepeatAction(LookupTableAction(), repeats=repeats),
+        reward_fn=CombinedReward(
+            (GoalReward(), 10.),
+            (TouchReward(), 0.1)
+        ),
+        termination_cond=GoalCondition(),
+        truncation_cond=AnyCondition(
+            TimeoutCondition(timeout=300.),
+            NoTouchTimeoutCondition(timeout=30.)
+        ),
+        transition_engine=RocketSimEngine(),
+        renderer=None,
+    )
+
+
+def run(env, steps: int, seed: int) -> float:
+    """
+    Steps `env` with random learner actions, resetting at the end of each episode.
+    Returns the wall time of the steps and resets.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+
+    t0 = time.perf_counter()
+    env.reset()
+    for _ in range(steps):
+        actions = {}
+        for agent_id, action_space in env.action_spaces.items():
+            actions[agent_id] = rng.integers(action_space, size=(1,))
+        _, _, terminated_dict, truncated_dict = env.step(actions)
+        if any(chain(terminated_dict.values(), truncated_dict.values())):
+            env.reset()
+    elapsed = time.perf_counter() - t0
+    env.close()
+    return elapsed
+
+
+def timed(make_env, steps: int, seed: int, trials: int) -> float:
+    # Median over fresh envs, as single runs are noisy
+    return median(run(make_env(), steps, seed) for _ in range(trials))
+
+
+def make_rcubed(team_size: int, repeats: int, opponent_chance: float, pool_size: int, base_url: str) -> RCubed:
+    env = RCubed(
+        **env_kwargs(team_size, repeats),
+        opponent_chance=opponent_chance,
+        opponent_base_url=base_url,
+        opponent_pool_size=pool_size,
+    )
+    env.register(ATBA)
+    return env
+
+
+def benchmark(steps: int, seed: int, trials: int, team_sizes: List[int], opponent_chances: List[float], pool_sizes: List[int], repeats_options: List[int]) -> List[Dict[str, Any]]:
+    server = start_stub_server()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    results = []
+    try:
+        for team_size, repeats in product(team_sizes, repeats_options):
+            baseline_s = timed(lambda: RLGym(**env_kwargs(team_size, repeats)), steps, seed, trials)
+            results.append(result("rlgym", team_size, repeats, steps, baseline_s, baseline_s))
+
+            for opponent_chance, pool_size in product(opponent_chances, pool_sizes):
+                elapsed = timed(lambda: make_rcubed(team_size, repeats, opponent_chance, pool_size, base_url), steps, seed, trials)
+                results.append(result("rcubed", team_size, repeats, steps, elapsed, baseline_s, opponent_chance, pool_size))
+    finally:
+        server.shutdown()
+    return results
+
+
+def result(env: str, team_size: int, repeats: int, steps: int, elapsed: float, baseline_s: float, opponent_chance: Optional[float]=None, pool_size: Optional[int]=None) -> Dict[str, Any]:
+    r = {
+        "env": env,
+        "team_size": team_size,
+        "repeats": repeats,
+        "opponent_chance": opponent_chance,
+        "pool_size": pool_size,
+        "steps": steps,
+        "seconds": elapsed,
+        "steps_per_second": steps / elapsed,
+        # Time relative to plain RLGym with the same team size and repeats
+        "overhead": elapsed / baseline_s,
+    }
+    print("{env:>6} | {team_size}v{team_size} | repeats {repeats} | opponent chance {opponent_chance} | pool {pool_size} | "
+          "{steps_per_second:.0f} steps/s | overhead {overhead:.3f}".format(**r))
+    return r
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+        prog='benchmarks.throughput',
+        description='Compares RCubed throughput against plain RLGym'
+    )
+    parser.add_argument('-o', '--output', help='Writes results as JSON to this path')
+    parser.add_argument('-n', '--steps', type=int, default=2000, help='Steps per configuration. Default 2000')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for learner actions and opponent selection. Default 0')
+    parser.add_argument('-t', '--trials', type=int, default=3, help='Runs per configuration, the median is reported. Default 3')
+    parser.add_argument('--team-sizes', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--opponent-chances', type=float, nargs='+', default=[0., 0.5, 1.])
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[1, 5])
+    parser.add_argument('--repeats', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+
+    results = benchmark(args.steps, args.seed, args.trials, args.team_sizes, args.opponent_chances, args.pool_sizes, args.repeats)
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "trials": args.trials,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
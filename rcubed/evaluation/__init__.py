@@ -0,0 +1,2 @@
+from .arena import Arena
+from .runner import EvaluationRunner
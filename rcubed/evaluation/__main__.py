@@ -0,0 +1,39 @@
+from argparse import ArgumentParser
+from importlib import import_module
+
+from rcubed.evaluation.runner import EvaluationRunner
+
+parser = ArgumentParser(
+    prog='rcubed.evaluation',
+    description='Plays registered opponents against each other on RocketSim and reports results to the R^3 server'
+)
+
+parser.add_argument('bots', nargs='+', metavar='MODULE:CLASS', help='Opponent classes to load models with, e.g. rcubed.premade:ATBA')
+parser.add_argument('-u', '--url', default='http://localhost:5151', help='R^3 server. Default http://localhost:5151')
+parser.add_argument('-p', '--processes', type=int, default=None, help='Matches played in parallel. Default one per CPU')
+parser.add_argument('-n', '--matches', type=int, default=None, help='Stops after this many matches. Default runs until interrupted')
+parser.add_argument('--team-size', type=int, default=1, help='Default 1')
+parser.add_argument('--tick-skip', type=int, default=8, help='Physics ticks per action. Default 8')
+parser.add_argument('--timeout', type=float, default=300., help='Game seconds before a match without a goal is abandoned. Default 300')
+parser.add_argument('--batch-size', type=int, default=32, help='Results posted per request. Default 32')
+
+args = parser.parse_args()
+
+bots = []
+for path in args.bots:
+    module_name, _, class_name = path.partition(':')
+    bots.append(getattr(import_module(module_name), class_name))
+
+runner = EvaluationRunner(
+    bots,
+    base_url=args.url,
+    processes=args.processes,
+    team_size=args.team_size,
+    tick_skip=args.tick_skip,
+    timeout_seconds=args.timeout,
+    batch_size=args.batch_size,
+)
+try:
+    runner.run(args.matches)
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,97 @@
+"""
+Plays registered opponents against each other, headless on RocketSim
+"""
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from rlgym.api import RLGym, StateMutator
+from rlgym.rocket_league.action_parsers import LookupTableAction, RepeatAction
+from rlgym.rocket_league.api import GameState
+from rlgym.rocket_league.common_values import BLUE_TEAM
+from rlgym.rocket_league.done_conditions import GoalCondition, TimeoutCondition
+from rlgym.rocket_league.obs_builders import DefaultObs
+from rlgym.rocket_league.reward_functions import GoalReward
+from rlgym.rocket_league.sim import RocketSimEngine
+from rlgym.rocket_league.state_mutators import MutatorSequence, FixedTeamSizeMutator, KickoffMutator
+
+from rcubed.wrapper.action import WrappedParser
+from rcubed.wrapper.botmanager import BotManager
+from rcubed.wrapper.common import BOT_MANAGER_KEY
+from rcubed.wrapper.modelcache import ModelCache
+from rcubed.wrapper.obs import WrappedObs
+from rcubed.wrapper.opponent import Opponent
+
+
+class LineupMutator(StateMutator[GameState]):
+    """
+    Hands the cars of each team to the opponents of the current lineup, in order.
+    """
+    def __init__(self):
+        self.lineup: Tuple[List[Opponent], List[Opponent]] = ([], [])
+
+    def apply(self, state: GameState, shared_info: Dict[str, Any]) -> None:
+        blue, orange = iter(self.lineup[0]), iter(self.lineup[1])
+        agents = list(state.cars.keys())
+        mapping = {agent: next(blue if state.cars[agent].team_num == BLUE_TEAM else orange) for agent in agents}
+        shared_info[BOT_MANAGER_KEY].assign(agents, mapping)
+
+
+class Arena:
+    """
+    One RocketSim arena that plays sudden death matches between lineups of models. Every car is
+    controlled by an opponent, loaded through the registered classes like in training.
+
+    Matches end at the first goal. Matches without a goal before `timeout_seconds` have no result,
+    since the server only rates wins.
+    """
+    def __init__(self, bots: List[Type[Opponent]], team_size: int, tick_skip: int=8, timeout_seconds: float=300., model_cache_size: int=32):
+        self.team_size = team_size
+        # Only used for loading, opponents come from the lineups rather than the server's pool
+        self.bot_manager = BotManager(opponent_chance=1., base_url='', model_cache=ModelCache(max_models=model_cache_size))
+        for bot in bots:
+            self.bot_manager.register(bot)
+        self.lineup_mutator = LineupMutator()
+        self.env = RLGym(
+            state_mutator=MutatorSequence(
+                FixedTeamSizeMutator(blue_size=team_size, orange_size=team_size),
+                KickoffMutator(),
+                self.lineup_mutator,
+            ),
+            # There are no learners, so these are never asked for observations or actions
+            obs_builder=WrappedObs(DefaultObs(zero_padding=None)),
+            action_parser=RepeatAction(WrappedParser(LookupTableAction()), repeats=tick_skip),
+            reward_fn=GoalReward(),
+            termination_cond=GoalCondition(),
+            truncation_cond=TimeoutCondition(timeout=timeout_seconds),
+            transition_engine=RocketSimEngine(),
+            renderer=None,
+        )
+        self.env.shared_info[BOT_MANAGER_KEY] = self.bot_manager
+
+    def play(self, team0: List[dict], team1: List[dict]) -> Optional[int]:
+        """
+        Plays one match between two teams of model records, as returned by the server.
+        Returns 0 if team0 scored, 1 if team1 scored, or None on timeout.
+        """
+        if len(team0) != self.team_size or len(team1) != self.team_size:
+            raise ValueError(f"Expected teams of {self.team_size}, got {len(team0)} and {len(team1)}")
+        self.lineup_mutator.lineup = (
+            [self.bot_manager.load_model(model) for model in team0],
+            [self.bot_manager.load_model(model) for model in team1],
+        )
+        obs = self.env.reset()
+        partition = self.bot_manager.partition
+        while True:
+            actions = {}
+            for opp, ids in partition.opponents:
+                ids = self.bot_manager.deciding_agents(opp, ids, obs)
+                if ids:
+                    actions.update(opp.act({agent: obs[agent] for agent in ids}))
+            obs, _, terminated, truncated = self.env.step(actions)
+            if any(terminated.values()):
+                # Blue is team0, so the scoring team is also the result
+                return self.env.state.scoring_team
+            if any(truncated.values()):
+                return None
+
+    def close(self) -> None:
+        self.env.close()
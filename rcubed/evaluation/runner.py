@@ -0,0 +1,139 @@
+"""
+Gets lineups from the server, plays them across a process pool and posts the results back
+"""
+from multiprocessing import get_context
+import time
+from typing import Dict, List, Optional, Tuple, Type
+from urllib.parse import urljoin
+
+import requests
+
+from rcubed.evaluation.arena import Arena
+from rcubed.wrapper.botmanager import combined_filter
+from rcubed.wrapper.opponent import Opponent
+
+# (team0 ids, team1 ids, result or None)
+MatchOutcome = Tuple[List[str], List[str], Optional[int]]
+
+_arena: Optional[Arena] = None
+
+
+def _init_worker(bots: List[Type[Opponent]], team_size: int, tick_skip: int, timeout_seconds: float) -> None:
+    # One arena per process, kept for every match so its model cache carries over
+    global _arena
+    _arena = Arena(bots, team_size, tick_skip, timeout_seconds)
+
+
+def _play(team0: List[dict], team1: List[dict]) -> MatchOutcome:
+    return [m["id"] for m in team0], [m["id"] for m in team1], _arena.play(team0, team1)
+
+
+class EvaluationRunner:
+    """
+    Keeps every worker busy with matches from /ts/match between models the registered classes
+    can load, and posts results to /ts/results in batches of `batch_size`, or after
+    `flush_seconds` if fewer are ready, so ratings keep moving while matches run.
+    """
+    def __init__(self,
+                 bots: List[Type[Opponent]],
+                 base_url: str='http://localhost:5151',
+                 processes: Optional[int]=None,
+                 team_size: int=1,
+                 tick_skip: int=8,
+                 timeout_seconds: float=300.,
+                 batch_size: int=32,
+                 flush_seconds: float=10.,
+                 ):
+        self.bots = bots
+        self.base_url = base_url
+        self.processes = processes or get_context().cpu_count()
+        self.team_size = team_size
+        self.tick_skip = tick_skip
+        self.timeout_seconds = timeout_seconds
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.session = requests.Session()
+        self.model_filter = combined_filter(bots)
+        # Model records rarely change and matches reuse the same models, so they're fetched once
+        self._models: Dict[str, dict] = {}
+        self.played = 0
+        self.posted = 0
+        self.timeouts = 0
+        self.failed = 0
+
+    def run(self, n_matches: Optional[int]=None) -> None:
+        """
+        Plays `n_matches` matches, or until interrupted if None.
+        """
+        pending_results = []
+        last_flush = time.monotonic()
+        ctx = get_context('spawn')
+        with ctx.Pool(self.processes, _init_worker, (self.bots, self.team_size, self.tick_skip, self.timeout_seconds)) as pool:
+            in_flight = []
+            started = 0
+            try:
+                while True:
+                    # Two matches per worker, so workers never wait on the server for their next one
+                    while len(in_flight) < 2 * self.processes and (n_matches is None or started < n_matches):
+                        team0, team1 = self.next_lineup()
+                        in_flight.append(pool.apply_async(_play, (team0, team1)))
+                        started += 1
+                    if len(in_flight) == 0:
+                        break
+
+                    in_flight[0].wait(timeout=0.1)
+                    still_running = []
+                    for match in in_flight:
+                        if not match.ready():
+                            still_running.append(match)
+                            continue
+                        self.played += 1
+                        try:
+                            team0_ids, team1_ids, result = match.get()
+                        except Exception as e:
+                            self.failed += 1
+                            print(f"Match failed: {e!r}")
+                            continue
+                        if result is None:
+                            self.timeouts += 1
+                            continue
+                        pending_results.append({"match": {"team0": team0_ids, "team1": team1_ids}, "result": result})
+                    in_flight = still_running
+
+                    if len(pending_results) >= self.batch_size or (pending_results and time.monotonic() - last_flush > self.flush_seconds):
+                        self.post_results(pending_results)
+                        pending_results = []
+                        last_flush = time.monotonic()
+            finally:
+                if pending_results:
+                    self.post_results(pending_results)
+                else:
+                    self.report()
+
+    def next_lineup(self) -> Tuple[List[dict], List[dict]]:
+        r = self.session.post(urljoin(self.base_url, '/ts/match'), json={
+            "bots": self.model_filter,
+            "teamSize": self.team_size,
+        })
+        r.raise_for_status()
+        lineup = r.json()
+        return [self.get_model(_id) for _id in lineup["team0"]], [self.get_model(_id) for _id in lineup["team1"]]
+
+    def get_model(self, model_id: str) -> dict:
+        model = self._models.get(model_id)
+        if model is None:
+            r = self.session.get(urljoin(self.base_url, f'/models/{model_id}'))
+            r.raise_for_status()
+            model = self._models[model_id] = r.json()
+        return model
+
+    def post_results(self, results: List[dict]) -> None:
+        r = self.session.post(urljoin(self.base_url, '/ts/results'), json={"results": results})
+        r.raise_for_status()
+        for error in r.json()["errors"]:
+            print(f"Result rejected: {error['error']}")
+        self.posted += len(results)
+        self.report()
+
+    def report(self) -> None:
+        print(f"Played {self.played} matches ({self.timeouts} timed out, {self.failed} failed), posted {self.posted} results")
@@ -1 +1,2 @@
-from rcubed.premade.atba import ATBA
\ No newline at end of file
+from rcubed.premade.atba import ATBA
+from rcubed.premade.mlp import MLPOpponent
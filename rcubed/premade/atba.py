@@ -5,26 +5,49 @@ from rlgym.rocket_league.api import GameState
 import numpy as np
 
 class LeftRightObs(ObsBuilder):
+    """
+    Whether the ball is to the right (1) or left (-1) of each car, computed for all agents at once.
+    """
     def reset(self, initial_state: Any, shared_info: Dict[str, Any]) -> None:
         pass
 
-    def build_obs(self, agents: List, state: Any, shared_info: Dict[str, Any]) -> Dict:
-        return {agent: self._build_obs(agent, state) for agent in agents}
-
-    def _build_obs(self, agent, state: GameState):
-        car_right = state.cars[agent].physics.right
-        car_to_ball = state.ball.position - state.cars[agent].physics.position
-        return np.array([1 if np.dot(car_right, car_to_ball) > 0 else -1])
+    def build_obs(self, agents: List, state: GameState, shared_info: Dict[str, Any]) -> Dict:
+        if len(agents) == 0:
+            return {}
+        cars = [state.cars[agent].physics for agent in agents]
+        car_right = np.array([car.right for car in cars])
+        car_to_ball = state.ball.position - np.array([car.position for car in cars])
+        side = np.where((car_right * car_to_ball).sum(axis=1) > 0, 1, -1)[:, None]
+        return dict(zip(agents, side))
     
     def get_obs_space(self, agent: Any) -> Any:
         return 1
     
 class LeftRightAction(ActionParser):
+    """
+    Full throttle and boost, steering by the action. Takes (ticks, 1) actions as produced
+    by RepeatAction, or (1,) for a single tick.
+
+    Controls are written into one buffer reused across calls, so the returned arrays are
+    only valid until the next call. The engine consumes them within the same step.
+    """
+    def __init__(self):
+        self._controls = np.zeros((0, 0, 8))
+
     def reset(self, initial_state: Any, shared_info: Dict[str, Any]) -> None:
         pass
 
     def parse_actions(self, actions: Dict, state: Any, shared_info: Dict[str, Any]) -> Dict:
-        return {k: np.stack([np.array([1, vv[0], 0, 0, 0, 0, 1, 0]) for vv in v]) for k, v in actions.items()}
+        if len(actions) == 0:
+            return {}
+        agents = list(actions)
+        steer = np.stack([np.asarray(actions[agent]).reshape(-1) for agent in agents])
+        if self._controls.shape[:2] != steer.shape:
+            self._controls = np.zeros((*steer.shape, 8))
+            self._controls[..., 0] = 1  # throttle
+            self._controls[..., 6] = 1  # boost
+        self._controls[..., 1] = steer
+        return dict(zip(agents, self._controls))
     
     def get_action_space(self, agent: Any) -> Any:
         return 1
@@ -45,6 +68,11 @@ class ATBA(Opponent):
     def action_parser(self):
         return self.action
 
+    @property
+    def obs_builder_key(self):
+        # LeftRightObs is stateless, so every ATBA can share one
+        return LeftRightObs
+
     @staticmethod
     def get_filter() -> Dict[str, Tuple[str, ...]]:
         return {"atba": ["atba"]}
@@ -0,0 +1,97 @@
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+from rlgym.api import ActionParser, ObsBuilder
+from rlgym.rocket_league.action_parsers import LookupTableAction
+from rlgym.rocket_league.obs_builders import DefaultObs
+
+from rcubed.wrapper import Opponent
+from rcubed.wrapper.artifacts import load_arrays
+
+_ACTIVATIONS = {
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+    'leaky_relu': lambda x: np.maximum(x, 0.01 * x, out=x),
+}
+
+
+class MLPOpponent(Opponent):
+    """
+    A feed-forward policy over DefaultObs with LookupTableAction, run in NumPy with no framework.
+
+    Weights are a .npz with `weight_0, bias_0, weight_1, ...`, each weight shaped (in, out), as written
+    by `MLPOpponent.save`. They're memory-mapped, so processes loading the same file share one copy.
+    All agents of an opponent go through the network as one batch. The last layer gives one logit
+    per lookup table action, and the highest is taken.
+
+    Subclass to set `get_filter`, and `activation` or `make_obs_builder` if they differ from training.
+    """
+    activation = 'relu'
+
+    def __init__(self, layers: Sequence[Tuple[np.ndarray, np.ndarray]]):
+        if self.activation not in _ACTIVATIONS:
+            raise ValueError(f"Unknown activation {self.activation!r}, expected one of {list(_ACTIVATIONS)}")
+        for i, ((weight, bias), nxt) in enumerate(zip(layers, [*layers[1:], None])):
+            if weight.ndim != 2 or bias.shape != weight.shape[1:]:
+                raise ValueError(f"Layer {i} has weight {weight.shape} and bias {bias.shape}, expected (in, out) and (out,)")
+            if nxt is not None and nxt[0].shape[0] != weight.shape[1]:
+                raise ValueError(f"Layer {i} outputs {weight.shape[1]} values, but layer {i + 1} takes {nxt[0].shape[0]}")
+        # Plain ndarray views of mapped weights, np.memmap adds overhead to every operation
+        self.layers = [(np.asarray(weight), np.asarray(bias)) for weight, bias in layers]
+        self.obs = self.make_obs_builder()
+        self.action = LookupTableAction()
+        n_actions = self.action.get_action_space(None)
+        if self.layers[-1][0].shape[1] != n_actions:
+            raise ValueError(f"The last layer outputs {self.layers[-1][0].shape[1]} logits, but there are {n_actions} actions")
+
+    def make_obs_builder(self) -> ObsBuilder:
+        return DefaultObs()
+
+    def act(self, obs: Dict) -> Dict:
+        keys = list(obs)
+        x = np.stack([obs[k] for k in keys]).astype(self.layers[0][0].dtype, copy=False)
+        activation = _ACTIVATIONS[self.activation]
+        for weight, bias in self.layers[:-1]:
+            x = activation(x @ weight + bias)
+        weight, bias = self.layers[-1]
+        actions = np.argmax(x @ weight + bias, axis=1)[:, None]
+        return dict(zip(keys, actions))
+
+    @property
+    def obs_builder(self) -> ObsBuilder:
+        return self.obs
+
+    @property
+    def action_parser(self) -> ActionParser:
+        return self.action
+
+    @property
+    def obs_builder_key(self):
+        # DefaultObs is stateless, so opponents of one class share it
+        return type(self)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(weight.nbytes + bias.nbytes for weight, bias in self.layers)
+
+    @classmethod
+    def load_from_location(cls, location: str, location_type: str, bot_name: str, run_name: str):
+        if location_type != 'file':
+            raise ValueError(f"{cls.__name__} loads 'file' locations, got {location_type!r}. Set opponent_artifact_dir to fetch other types to files")
+        arrays = load_arrays(location)
+        n_layers = sum(1 for name in arrays if name.startswith('weight_'))
+        if n_layers == 0:
+            raise ValueError(f"{location} has no weight_0 array")
+        return cls([(arrays[f'weight_{i}'], arrays[f'bias_{i}']) for i in range(n_layers)])
+
+    @staticmethod
+    def save(path: str, layers: Sequence[Tuple[np.ndarray, np.ndarray]]) -> None:
+        """
+        Writes layers as an uncompressed .npz that can be memory-mapped. Weights are (in, out), so a
+        PyTorch `nn.Linear` weight needs transposing first.
+        """
+        arrays: Dict[str, np.ndarray] = {}
+        for i, (weight, bias) in enumerate(layers):
+            arrays[f'weight_{i}'] = np.ascontiguousarray(weight)
+            arrays[f'bias_{i}'] = np.ascontiguousarray(bias)
+        np.savez(path, **arrays)
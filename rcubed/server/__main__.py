@@ -1,17 +1,52 @@
 from rcubed.server.app import app
 from rcubed.server.db import RCubedDB
+from rcubed.server.proxy import create_proxy_app
+from rcubed.server.recompute import recompute
+from rcubed.server.serving import serve
 from argparse import ArgumentParser
+import trueskill
 
 parser = ArgumentParser(
     prog='rcubed.server',
     description='R^3 model server'
 )
 
-parser.add_argument('db_path')
+parser.add_argument('db_path', nargs='?', help='Required unless running with --proxy')
 parser.add_argument('-p', '--port', type=int, default=5151, help='Runs on the provided port. Default 5151')
+parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on. Use 0.0.0.0 to accept remote connections. Default 127.0.0.1')
+parser.add_argument('-w', '--workers', type=int, default=16, help='Number of request handling threads. These overlap waits on I/O but share one core. Default 16')
+parser.add_argument('--debug', action='store_true', help='Runs the single threaded Flask development server with the debugger and reloader')
+parser.add_argument('--proxy', metavar='UPSTREAM_URL', help='Runs as a caching proxy for the server at this URL instead, for env processes on one node to share')
+parser.add_argument('--proxy-ttl', type=float, default=5., help='Seconds model reads are cached for with --proxy. Default 5')
+parser.add_argument('--ts-beta', type=float, default=trueskill.BETA, help=f'TrueSkill beta, used for rating and matchmaking. Default {trueskill.BETA:.3f}')
+parser.add_argument('--ts-tau', type=float, default=trueskill.TAU, help=f'TrueSkill tau, the rating drift per match. Default {trueskill.TAU:.4f}')
+parser.add_argument('--ts-draw-probability', type=float, default=trueskill.DRAW_PROBABILITY, help=f'TrueSkill draw probability. Default {trueskill.DRAW_PROBABILITY}')
+parser.add_argument('--leaderboard-k', type=float, default=3., help='Leaderboard ranks models by mu - k * sigma. Default 3')
+parser.add_argument('--void-matches', type=int, nargs='+', metavar='MATCH_ID', help='Excludes these matches from the log. Implies --recompute')
+parser.add_argument('--recompute', action='store_true', help='Rebuilds every rating by replaying the match log with the TrueSkill settings above, then exits. Restart any running server afterwards so it reloads the ratings')
 
 args = parser.parse_args()
+if args.db_path is None and args.proxy is None:
+    parser.error('db_path is required unless running with --proxy')
 
 app.config['db'] = args.db_path
+app.config['leaderboard_k'] = args.leaderboard_k
+trueskill.setup(beta=args.ts_beta, tau=args.ts_tau, draw_probability=args.ts_draw_probability)
 
-app.run(port=args.port, debug=True)
+if args.proxy:
+    serve(create_proxy_app(args.proxy, args.proxy_ttl), args.host, args.port, args.workers)
+elif args.recompute or args.void_matches:
+    db = RCubedDB(args.db_path)
+    if args.void_matches:
+        print(f"Voided {db.void_matches(args.void_matches)} matches")
+    print(f"Replayed {recompute(db)} matches")
+    db.close()
+elif args.debug:
+    app.run(host=args.host, port=args.port, debug=True)
+else:
+    try:
+        serve(app, args.host, args.port, args.workers)
+    finally:
+        pool = app.extensions.get('rcubed_db_pool')
+        if pool is not None:
+            pool.close()
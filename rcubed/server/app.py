@@ -1,29 +1,79 @@
-from random import choices, randint, sample
-from typing import Dict, List
-from flask import Flask, request
-from rcubed.server.db import RCubedDB
-from trueskill import Rating, quality, rate
+from heapq import nlargest
+from random import choices, randint, random
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from flask import Flask, g, request
+import numpy as np
+from rcubed.server.db import RCubedDB, RCubedDBPool
+from rcubed.server.matchmaking import MAX_TEAM_SIZE, find_match
+from rcubed.server.ratingindex import RatingIndex
+from rcubed.server.recompute import rate_two_teams
+from trueskill import global_env
 
 app = Flask(__name__)
 
+_pool_lock = threading.Lock()
+_index_lock = threading.Lock()
+
+def get_pool() -> RCubedDBPool:
+    with _pool_lock:
+        pool = app.extensions.get('rcubed_db_pool')
+        if pool is None or pool.fpath != app.config['db']:
+            pool = RCubedDBPool(app.config['db'])
+            app.extensions['rcubed_db_pool'] = pool
+        return pool
+
+def get_db() -> RCubedDB:
+    # One pooled connection per request, returned by release_db
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+def get_rating_index() -> RatingIndex:
+    # Built from the database on first use, then kept up to date by every rating write
+    with _index_lock:
+        index = app.extensions.get('rcubed_rating_index')
+        if index is None:
+            index = RatingIndex(app.config.get('leaderboard_k', 3.))
+            index.load(get_db())
+            app.extensions['rcubed_rating_index'] = index
+        return index
+
+@app.teardown_appcontext
+def release_db(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        get_pool().release(db)
+
 @app.get('/models')
 def get_models():
-    page = request.args.get('page', 0)
-    page = int(page) if page else 0
+    after = request.args.get('after', None)
+    after = int(after) if after else None
     run = request.args.get('run', None)
     bot = request.args.get('bot', None)
-    db = RCubedDB(app.config['db'])
-    models = db.get_models(page, run, bot)
-    has_next_page = db.get_num_models() > 50 + 50 * page
-    if has_next_page:
-        return {"data": models, "nextPage": page + 1}
+    db = get_db()
+    models, next_cursor = db.get_models(after, run, bot)
+    if next_cursor is not None:
+        return {"data": models, "nextCursor": next_cursor}
     else:
         return {"data": models}
 
+@app.get('/models/latest')
+def get_latest_model():
+    run = request.args.get('run', None)
+    bot = request.args.get('bot', None)
+    if run is None or bot is None:
+        return {"error": "Both bot and run are required"}, 400
+    db = get_db()
+    model = db.get_latest_model(bot, run)
+    if model is None:
+        return {"error": f"No models for bot {bot} and run {run}"}, 404
+    return model
+
 @app.post('/models')
 def create_model():
     model_stub = request.json
-    db = RCubedDB(app.config['db'])
+    db = get_db()
     partial_model = db.create_model(
         model_stub["runName"],
         model_stub["botName"],
@@ -31,11 +81,12 @@ def create_model():
         model_stub["location"]["value"],
         model_stub.get("steps", None)
     )
+    get_rating_index().refresh(db, [partial_model["id"]])
     return {**model_stub, **partial_model}, 201
 
 @app.get('/models/<modelId>')
 def get_model(modelId: str):
-    db = RCubedDB(app.config['db'])
+    db = get_db()
     model = db.get_model(modelId)
     if model is None:
         return {"error": f"No model with id {modelId}"}, 404
@@ -44,7 +95,7 @@ def get_model(modelId: str):
 @app.patch('/models/<modelId>')
 def update_model(modelId: str):
     update = request.json
-    db = RCubedDB(app.config['db'])
+    db = get_db()
     db.update_model(
         modelId,
         update.get('runName', None),
@@ -54,67 +105,167 @@ def update_model(modelId: str):
         update.get('ts', None),
         update.get('steps', None)
     )
+    get_rating_index().refresh(db, [modelId])
     return '', 204
 
 @app.delete('/models/<modelId>')
 def delete_model(modelId: str):
-    db = RCubedDB(app.config['db'])
+    db = get_db()
     db.delete_model(modelId)
+    get_rating_index().refresh(db, [modelId])
     return '', 204
 
+def _int_param(value, name: str, maximum: Optional[int]=None) -> Tuple[Optional[int], Optional[str]]:
+    # (value, None) if it is an integer from 1 to maximum, otherwise (None, error message)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1 or (maximum is not None and value > maximum):
+        expected = 'a positive integer' if maximum is None else f'an integer from 1 to {maximum}'
+        return None, f"{name} must be {expected}, got {value!r}"
+    return value, None
+
+@app.get('/leaderboard')
+def get_leaderboard():
+    bot = request.args.get('bot', None)
+    run = request.args.get('run', None)
+    limit = request.args.get('limit', '50')
+    try:
+        limit = int(limit)
+    except ValueError:
+        # Reported as given
+        pass
+    limit, error = _int_param(limit, "limit", 500)
+    if error is not None:
+        return {"error": error}, 400
+    after = request.args.get('after', None)
+    if after:
+        # "score:id" from a previous page
+        score, _, model_id = after.partition(':')
+        try:
+            after = (-float(score), model_id)
+        except ValueError:
+            return {"error": f"Invalid cursor {after}"}, 400
+    index = get_rating_index()
+    rows, next_key = index.get_leaderboard(bot, run, after, limit)
+    body = {
+        "k": index.leaderboard_k,
+        "data": [{
+            "rank": rank,
+            "id": model_id,
+            "botName": bot_name,
+            "runName": run_name,
+            "ts": {"mu": mu, "sigma": sigma},
+            "score": score,
+        } for rank, model_id, bot_name, run_name, mu, sigma, score in rows],
+    }
+    if next_key is not None:
+        body["nextCursor"] = f"{-next_key[0]!r}:{next_key[1]}"
+    return body
+
 @app.post('/ts/match')
 def get_match():
     body = request.json
-    db = RCubedDB(app.config['db'])
+    team_size, error = _int_param(body.get("teamSize", 3), "teamSize", MAX_TEAM_SIZE)
+    if error is not None:
+        return {"error": error}, 400
+    # Larger counts are capped by find_match
+    n_candidates, error = _int_param(body.get("numCandidates", 1000), "numCandidates")
+    if error is not None:
+        return {"error": error}, 400
+    index = get_rating_index()
     # Choose a model with high sigma to always include
-    sigma_models = db.get_by_sigma(body["bots"])
+    sigma_models = index.get_by_sigma(body["bots"])
     chosen = sigma_models[randint(0, len(sigma_models)-1)]
     # Get models that can participate (make sure chosen is first)
-    models = [(chosen[0], 0, chosen[1], chosen[2])] + [m for m in db.get_by_mu(chosen[1], body["bots"], 20) if m[0] != chosen[0]]
-    ratings = [Rating(m[2], m[3]) for m in models]
-    n_models = len(models)
+    models = [(chosen[0], 0, chosen[1], chosen[2])] + [m for m in index.get_by_mu(chosen[1], body["bots"], 20) if m[0] != chosen[0]]
+    mu = np.array([m[2] for m in models], dtype=np.float64)
+    sigma = np.array([m[3] for m in models], dtype=np.float64)
     # Find a fair matchup
-    best_q = 0
-    best_match = None
-    for _ in range(10):
-        candidate = [
-            [0] + [randint(0, n_models-1) for _ in range(3-1)],
-            [randint(0, n_models-1) for _ in range(3)],
-        ]
-        q = quality([[ratings[c] for c in candidate[0]], [ratings[c] for c in candidate[1]]])
-        if q > best_q:
-            best_q = q
-            best_match = [[models[c][0] for c in candidate[0]], [models[c][0] for c in candidate[1]]]
-    return {"team0": best_match[0], "team1": best_match[1]}
+    team0, team1, _ = find_match(
+        mu,
+        sigma,
+        team_size,
+        n_candidates,
+        np.random.default_rng()
+    )
+    return {"team0": [models[c][0] for c in team0], "team1": [models[c][0] for c in team1]}
+
+def rate_match(ratings: Dict[str, Tuple[float, float]], match: Dict[str, List[str]], result: int, ts_anchor: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Returns the new (mu, sigma) of every model in the match, except the anchor.
+    `ratings` must contain every model in the match. Result 0 means team0 won, 1 means team1 won.
+    """
+    if result not in (0, 1):
+        raise ValueError(f"Result must be 0 or 1, got {result}")
+    for _id in match["team0"] + match["team1"]:
+        if _id not in ratings:
+            raise ValueError(f"No model with id {_id}")
+    # Same update as replays, so recomputing the log reproduces live ratings
+    return rate_two_teams(ratings, match["team0"], match["team1"], result == 0, global_env(), fixed=(ts_anchor,))
+
+def apply_results(db: RCubedDB, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Rates each result in order, with one read of the ratings involved and one write transaction.
+    Rated results are added to the match log in the same transaction. Results that can't be rated
+    are skipped, and returned as errors with their position in `results`.
+    """
+    errors = []
+    with db.transaction():
+        ts_anchor = db.get_setting('ts_anchor')
+        model_ids = []
+        for r in results:
+            try:
+                model_ids.extend(r["match"]["team0"] + r["match"]["team1"])
+            except (KeyError, TypeError):
+                # Reported when the result is rated
+                pass
+        ratings = {_id: (m["ts"]["mu"], m["ts"]["sigma"]) for _id, m in db.get_models_by_ids(model_ids).items()}
+        updated = set()
+        rated = []
+        for i, r in enumerate(results):
+            try:
+                new_ratings = rate_match(ratings, r["match"], r["result"], ts_anchor)
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({"index": i, "error": str(e) if isinstance(e, ValueError) else f"Malformed result: {e!r}"})
+                continue
+            ratings.update(new_ratings)
+            updated.update(new_ratings.keys())
+            rated.append((r["match"]["team0"], r["match"]["team1"], r["result"]))
+        db.update_ratings({_id: ratings[_id] for _id in updated})
+        db.insert_matches(rated)
+    get_rating_index().refresh(db, list(updated))
+    return errors
 
 @app.post('/ts/result')
 def post_result():
     body = request.json
-    db = RCubedDB(app.config['db'])
-    team0 = [db.get_model(m) for m in body["match"]["team0"]]
-    team0 = [Rating(mu=m["ts"]["mu"], sigma=m["ts"]["sigma"]) for m in team0]
-    team1 = [db.get_model(m) for m in body["match"]["team1"]]
-    team1 = [Rating(mu=m["ts"]["mu"], sigma=m["ts"]["sigma"]) for m in team1]
-    ts_anchor = db.get_setting('ts_anchor')
-    # Lower is better, so 0 < 0.5 and 1 > 0.5
-    updated_t0, updated_t1 = rate([team0, team1], [body["result"], 0.5])
-    ratings: Dict[str, List[Rating]] = {}
-    for rating, _id in zip(updated_t0 + updated_t1, body["match"]["team0"] + body["match"]["team1"]):
-        # ts_anchor should never be updated
-        if _id == ts_anchor:
-            continue
-        ratings.setdefault(_id, []).append(rating)
-    
-    for _id, rs in ratings.items():
-        db.update_model(_id, ts={"mu": sum(r.mu for r in rs) / len(rs), "sigma": sum(r.sigma for r in rs)})
-
+    db = get_db()
+    errors = apply_results(db, [body])
+    if len(errors) > 0:
+        return {"error": errors[0]["error"]}, 400
     return '', 204
 
+@app.post('/ts/results')
+def post_results():
+    body = request.json
+    db = get_db()
+    errors = apply_results(db, body["results"])
+    return {"errors": errors}
+
 
 @app.post('/ts/opponents')
 def get_opponents():
     body = request.json
-    db = RCubedDB(app.config['db'])
-    models_with_dmu = db.get_by_mu(body['for']['mu'], body['bots'], max(50, body['numOpponents'] * 5))
-    chosen = sample(models_with_dmu, min(body["numOpponents"], len(models_with_dmu)), counts=range(len(models_with_dmu), 0, -1))
+    db = get_db()
+    exclude = set(body.get('exclude', ()))
+    models_with_dmu = get_rating_index().get_by_mu(body['for']['mu'], body['bots'], max(50, body['numOpponents'] * 5) + len(exclude))
+    if exclude:
+        # Rolling pools ask for replacements that aren't already loaded
+        models_with_dmu = [m for m in models_with_dmu if m[0] not in exclude]
+    # Closer models are weighted higher by rank. Each model is drawn at most once, which
+    # sample(counts=...) doesn't guarantee since it counts every copy as a separate element
+    keyed = [(random() ** (1 / w), m) for w, m in zip(range(len(models_with_dmu), 0, -1), models_with_dmu)]
+    chosen = [m for _, m in nlargest(body["numOpponents"], keyed, key=lambda k: k[0])]
+    if body.get('expand', False):
+        # Full model records, so clients don't need a request per opponent
+        models = db.get_models_by_ids([m[0] for m in chosen])
+        return [models[m[0]] for m in chosen]
     return [m[0] for m in chosen]
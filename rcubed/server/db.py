@@ -1,16 +1,70 @@
+from contextlib import contextmanager
+import json
 import sqlite3
 import os
-from typing import Any, Dict, List, Optional, Literal, Tuple
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Literal, Tuple
 from uuid import uuid4
 from datetime import datetime
 
-SCHEMA_LATEST = 1
+SCHEMA_LATEST = 7
+
+# Statements that upgrade the schema to each version from the one before it
+MIGRATIONS: Dict[int, List[str]] = {
+    2: [
+        # Serves "latest model for a run" without scanning every checkpoint
+        'CREATE INDEX model_bot_run_steps ON model(botName, runName, steps, created)',
+    ],
+    3: [
+        # Filtered rating lookups for /ts/opponents and /ts/match
+        'CREATE INDEX model_bot_run_mu ON model(botName, runName, mu)',
+        'CREATE INDEX model_bot_run_sigma ON model(botName, runName, sigma)',
+    ],
+    4: [
+        # Every rated result, so ratings can be rebuilt by rcubed.server.recompute
+        'CREATE TABLE match_log(\
+            id INTEGER PRIMARY KEY,\
+            created TEXT,\
+            team0 TEXT,\
+            team1 TEXT,\
+            result INT,\
+            voided INT NOT NULL DEFAULT 0)',
+        # Where replays start each model from. Ratings from before the log existed are the best we have
+        'ALTER TABLE model ADD COLUMN initMu NUM',
+        'ALTER TABLE model ADD COLUMN initSigma NUM',
+        'UPDATE model SET initMu = mu, initSigma = sigma',
+    ],
+    5: [
+        # Which model a checkpoint inherited its rating from, and the last logged match at the time,
+        # so replays hand over the parent's replayed rating instead of the stored initMu/initSigma
+        'ALTER TABLE model ADD COLUMN parentId TEXT',
+        'ALTER TABLE model ADD COLUMN parentMatch INT',
+    ],
+    6: [
+        # Filtered /models pages. Index entries end in the rowid, so `ORDER BY rowid` after
+        # `rowid > ?` is a range scan instead of a sort of the whole run
+        'CREATE INDEX model_bot_run ON model(botName, runName)',
+        'CREATE INDEX model_run ON model(runName)',
+        'CREATE INDEX model_bot ON model(botName)',
+    ],
+    7: [
+        # Version 5 recorded the run's checkpoint with the fewest steps as the parent. Point each child at the
+        # one with the most steps among those created before it, which `recompute` then replays from
+        '''UPDATE model SET parentId = (
+            SELECT parent.id FROM model AS parent
+            WHERE parent.botName = model.botName AND parent.runName = model.runName AND parent.rowid < model.rowid
+            ORDER BY parent.steps DESC, parent.created DESC
+            LIMIT 1)
+        WHERE parentId IS NOT NULL''',
+    ],
+}
 
 def init_db(fpath: str, defaults: dict={}):
     now = datetime.now().isoformat()
     db = sqlite3.connect(fpath)
     cur = db.cursor()
-    cur.execute(f'PRAGMA user_version = {SCHEMA_LATEST}')
+    # New databases start at version 1 and are brought up to date by migrate_db
+    cur.execute('PRAGMA user_version = 1')
     cur.execute('CREATE TABLE model(\
                 id TEXT PRIMARY KEY,\
                 runName TEXT,\
@@ -28,58 +82,125 @@ def init_db(fpath: str, defaults: dict={}):
     cur.close()
     db.close()
 
+def migrate_db(db: sqlite3.Connection) -> None:
+    # Takes the write lock first so concurrent connections don't apply the same migration twice
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for target in range(version + 1, SCHEMA_LATEST + 1):
+            print(f"Migrating database to version {target}")
+            for statement in MIGRATIONS[target]:
+                db.execute(statement)
+            db.execute(f'PRAGMA user_version = {target}')
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+MODEL_COLUMNS = 'id, runName, botName, created, mu, sigma, steps, locationType, locationValue'
+
+def model_from_row(row: tuple) -> dict:
+    return {
+        "id": row[0],
+        "runName": row[1],
+        "botName": row[2],
+        "created": row[3],
+        "ts": {
+            "mu": row[4],
+            "sigma": row[5],
+        },
+        "steps": row[6],
+        "location": {
+            "type": row[7],
+            "value": row[8]
+        }
+    }
+
 class RCubedDB:
-    def __init__(self, fpath: str):
+    def __init__(self, fpath: str, check_same_thread: bool=True):
         if not os.path.exists(fpath):
             print("Database does not exist. Creating new database.")
             init_db(fpath)
-        self._db = sqlite3.connect(fpath)
+        self._db = sqlite3.connect(fpath, check_same_thread=check_same_thread)
+        # WAL lets readers carry on while a writer commits, and NORMAL sync is safe under WAL
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = NORMAL')
+        self._db.execute('PRAGMA busy_timeout = 5000')
         cur = self._db.execute('PRAGMA user_version')
         version = cur.fetchone()[0]
         cur.close()
-        if version != SCHEMA_LATEST:
-            print(f"Database version is out of date. Expected {SCHEMA_LATEST}, got {version}")
+        if version < SCHEMA_LATEST:
+            migrate_db(self._db)
+        elif version > SCHEMA_LATEST:
+            print(f"Database version is newer than this server. Expected {SCHEMA_LATEST}, got {version}")
             exit(-1)
 
         self.page_size = 50
+        # Set while inside transaction(), so writes leave committing to it
+        self._in_transaction_block = False
 
-    def get_models(self, page: int=0, run: str=None, bot: str=None) -> list:
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a single write transaction, committed at the end or rolled back on error.
+        The write lock is taken up front so reads inside the block can't go stale.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        self._in_transaction_block = True
+        try:
+            yield self
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        finally:
+            self._in_transaction_block = False
+
+    def get_models(self, after: Optional[int]=None, run: str=None, bot: str=None) -> Tuple[list, Optional[int]]:
+        """
+        Returns a page of models, and the cursor for the next page if there is one.
+        Pages are keyed on rowid, so each page is a range scan rather than an offset.
+        """
         condition_data = []
         conditions = []
+        if after is not None:
+            conditions.append('rowid > ?')
+            condition_data.append(after)
         if run is not None:
             conditions.append('runName = ?')
             condition_data.append(run)
         if bot is not None:
             conditions.append('botName = ?')
             condition_data.append(bot)
+        # One extra row tells us whether there is another page
         cur = self._db.execute(
-f'''SELECT id, runName, botName, created, mu, sigma, steps, locationType, locationValue
+f'''SELECT rowid, {MODEL_COLUMNS}
 FROM model
 {'WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''}
-LIMIT ?, ?;
-''', (*condition_data, page * self.page_size, self.page_size))
+ORDER BY rowid
+LIMIT ?;
+''', (*condition_data, self.page_size + 1))
         rows = cur.fetchall()
-        models = [
-            {
-                "id": row[0],
-                "runName": row[1],
-                "botName": row[2],
-                "created": row[3],
-                "ts": {
-                    "mu": row[4],
-                    "sigma": row[5],
-                },
-                "steps": row[6],
-                "location": {
-                    "type": row[7],
-                    "value": row[8]
-                }
-            }
-            for row in rows
-        ]
-        self._db.commit()
         cur.close()
-        return models
+        has_next_page = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        models = [model_from_row(row[1:]) for row in rows]
+        return models, rows[-1][0] if has_next_page else None
+
+    def get_latest_model(self, bot: str, run: str) -> Optional[dict]:
+        """
+        The model of a run with the most steps, newest first on ties.
+        """
+        cur = self._db.execute(
+f'''SELECT {MODEL_COLUMNS}
+FROM model
+WHERE botName = ? AND runName = ?
+ORDER BY steps DESC, created DESC
+LIMIT 1
+''', (bot, run))
+        row = cur.fetchone()
+        cur.close()
+        return row and model_from_row(row)
     
     def get_num_models(self) -> int:
         cur = self._db.execute('SELECT COUNT(*) FROM model')
@@ -98,19 +219,20 @@ LIMIT ?, ?;
         model_id = uuid4()
         created = datetime.now().isoformat()
         # If there is a previous model with the same run and bot name,
-        # inherit its trueskill
+        # inherit the trueskill of the one with the most steps
+        # One statement, so the rating and the last match are read from the same snapshot
         cur = self._db.execute(
-'''SELECT mu, sigma FROM model
+'''SELECT id, mu, sigma, (SELECT COALESCE(MAX(id), 0) FROM match_log) FROM model
 WHERE runName = ? AND botName = ?
-ORDER BY steps, created DESC
+ORDER BY steps DESC, created DESC
 LIMIT 1
 ''',
         (run_name, bot_name))
         # defaults from https://trueskill.org/#rating-the-model-for-skill
-        mu, sigma = cur.fetchone() or (25, 25 / 3)
+        parent_id, mu, sigma, parent_match = cur.fetchone() or (None, 25, 25 / 3, None)
         cur.execute(
-            'INSERT INTO model VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            (str(model_id), run_name, bot_name, created, mu, sigma, steps, location_type, location_value)
+            f'INSERT INTO model ({MODEL_COLUMNS}, initMu, initSigma, parentId, parentMatch) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (str(model_id), run_name, bot_name, created, mu, sigma, steps, location_type, location_value, mu, sigma, parent_id, parent_match)
         )
         self._db.commit()
         cur.close()
@@ -118,27 +240,29 @@ LIMIT 1
     
     def get_model(self, model_id: str):
         cur = self._db.execute(
-'''SELECT id, runName, botName, created, mu, sigma, steps, locationType, locationValue
+f'''SELECT {MODEL_COLUMNS}
 FROM model
 WHERE id = ?
 ''', (model_id,))
         row = cur.fetchone()
         cur.close()
-        return row and {
-            "id": row[0],
-            "runName": row[1],
-            "botName": row[2],
-            "created": row[3],
-            "ts": {
-                "mu": row[4],
-                "sigma": row[5],
-            },
-            "steps": row[6],
-            "location": {
-                "type": row[7],
-                "value": row[8]
-            }
-        }
+        return row and model_from_row(row)
+
+    def get_models_by_ids(self, model_ids: List[str]) -> Dict[str, dict]:
+        """
+        Fetches several models in one query. Ids that don't exist are left out of the result.
+        """
+        unique_ids = list(set(model_ids))
+        if len(unique_ids) == 0:
+            return {}
+        cur = self._db.execute(
+f'''SELECT {MODEL_COLUMNS}
+FROM model
+WHERE id IN ({", ".join(["?"] * len(unique_ids))})
+''', unique_ids)
+        rows = cur.fetchall()
+        cur.close()
+        return {row[0]: model_from_row(row) for row in rows}
 
     def update_model(
         self,
@@ -184,6 +308,17 @@ WHERE id = ?
         self._db.commit()
         cur.close()
 
+    def update_ratings(self, ratings: Dict[str, Tuple[float, float]]) -> None:
+        """
+        Sets (mu, sigma) for several models at once.
+        """
+        self._db.executemany(
+            'UPDATE model SET mu = ?, sigma = ? WHERE id = ?',
+            [(mu, sigma, model_id) for model_id, (mu, sigma) in ratings.items()]
+        )
+        if not self._in_transaction_block:
+            self._db.commit()
+
     def delete_model(self, model_id: str) -> Tuple[str, float]:
         cur = self._db.execute('DELETE FROM model WHERE id = ?', (model_id,))
         self._db.commit()
@@ -226,6 +361,69 @@ LIMIT ?
         return values
 
     
+    def get_ratings(self) -> List[Tuple[str, str, str, float, float]]:
+        """
+        (id, botName, runName, mu, sigma) for every model, used to build the rating index.
+        """
+        cur = self._db.execute('SELECT id, botName, runName, mu, sigma FROM model')
+        ratings = cur.fetchall()
+        cur.close()
+        return ratings
+
+    def get_initial_ratings(self) -> Dict[str, Tuple[float, float]]:
+        """
+        (mu, sigma) of every model when it was created, the starting point for replays.
+        """
+        cur = self._db.execute('SELECT id, initMu, initSigma FROM model')
+        ratings = {model_id: (mu, sigma) for model_id, mu, sigma in cur}
+        cur.close()
+        return ratings
+
+    def get_inheritance(self) -> List[Tuple[int, str, str]]:
+        """
+        (last match id, child id, parent id) for every model that inherited its rating, in the order they were created.
+        """
+        cur = self._db.execute('SELECT parentMatch, id, parentId FROM model WHERE parentId IS NOT NULL ORDER BY parentMatch, rowid')
+        inheritance = cur.fetchall()
+        cur.close()
+        return inheritance
+
+    def insert_matches(self, matches: List[Tuple[List[str], List[str], int]]) -> None:
+        """
+        Appends (team0, team1, result) matches to the match log.
+        """
+        created = datetime.now().isoformat()
+        self._db.executemany(
+            'INSERT INTO match_log (created, team0, team1, result) VALUES (?, ?, ?, ?)',
+            [(created, json.dumps(team0), json.dumps(team1), result) for team0, team1, result in matches]
+        )
+        if not self._in_transaction_block:
+            self._db.commit()
+
+    def iter_matches(self) -> Iterator[Tuple[int, List[str], List[str], int]]:
+        """
+        (id, team0, team1, result) for every match that hasn't been voided, oldest first.
+        Rows are streamed, so the log doesn't have to fit in memory as tuples.
+        """
+        cur = self._db.execute('SELECT id, team0, team1, result FROM match_log WHERE voided = 0 ORDER BY id')
+        loads = json.loads
+        try:
+            for match_id, team0, team1, result in cur:
+                yield match_id, loads(team0), loads(team1), result
+        finally:
+            cur.close()
+
+    def void_matches(self, match_ids: List[int]) -> int:
+        """
+        Excludes matches from future replays. Returns how many were found.
+        """
+        cur = self._db.executemany('UPDATE match_log SET voided = 1 WHERE id = ?', [(match_id,) for match_id in match_ids])
+        count = cur.rowcount
+        cur.close()
+        if not self._in_transaction_block:
+            self._db.commit()
+        return count
+
     def get_setting(self, key) -> str:
         cur = self._db.execute('SELECT val FROM setting WHERE key = ?', (key,))
         val = cur.fetchone()[0]
@@ -233,7 +431,44 @@ LIMIT ?
         return val
 
     
+    def rollback(self):
+        if self._db.in_transaction:
+            self._db.rollback()
+
     def close(self):
         self._db.close()
         self._db = None
+
+
+class RCubedDBPool:
+    """
+    Hands out long-lived connections so requests don't reconnect and re-check the schema.
+    Connections are used by one thread at a time, but may move between threads.
+    """
+    def __init__(self, fpath: str, max_idle: int=16):
+        self.fpath = fpath
+        self.max_idle = max_idle
+        self._idle: List[RCubedDB] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> RCubedDB:
+        with self._lock:
+            if len(self._idle) > 0:
+                return self._idle.pop()
+        return RCubedDB(self.fpath, check_same_thread=False)
+
+    def release(self, db: RCubedDB) -> None:
+        # Don't hand out a connection with a half finished transaction
+        db.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(db)
+                return
+        db.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
         
\ No newline at end of file
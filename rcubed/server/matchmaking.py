@@ -0,0 +1,58 @@
+"""
+Scores many candidate lineups at once to find fair evaluation matches
+"""
+from typing import List, Tuple
+
+import numpy as np
+from trueskill import global_env
+
+# Upper bound on lineups scored per request, to keep request latency bounded
+MAX_CANDIDATES = 100_000
+# Largest team size a lineup can be requested for
+MAX_TEAM_SIZE = 8
+
+
+def match_quality(mu: np.ndarray, sigma: np.ndarray, team0: np.ndarray, team1: np.ndarray, beta: float) -> np.ndarray:
+    """
+    TrueSkill match quality (the draw probability) for a batch of two team lineups.
+
+    `team0` and `team1` are (candidates, team size) arrays of indices into `mu` and `sigma`.
+    For two teams the general quality formula reduces to
+    sqrt(n b^2 / (n b^2 + sum(sigma^2))) * exp(-dmu^2 / (2 (n b^2 + sum(sigma^2)))),
+    which matches `trueskill.quality` for unweighted players.
+    """
+    n_players = team0.shape[1] + team1.shape[1]
+    var = sigma ** 2
+    d_mu = mu[team0].sum(axis=1) - mu[team1].sum(axis=1)
+    denom = n_players * beta ** 2 + var[team0].sum(axis=1) + var[team1].sum(axis=1)
+    return np.sqrt(n_players * beta ** 2 / denom) * np.exp(-d_mu ** 2 / (2 * denom))
+
+
+def find_match(mu: np.ndarray, sigma: np.ndarray, team_size: int, n_candidates: int, rng: np.random.Generator) -> Tuple[List[int], List[int], float]:
+    """
+    Finds the fairest lineup, where model 0 always plays first on team 0 and every other slot
+    can be filled by any model. Models can repeat within a team, but lineups with a model on both
+    teams are only picked if nothing else is possible, since a model playing itself is always
+    the fairest match and teaches us nothing. Every lineup is scored if there are at most
+    `n_candidates` of them, otherwise `n_candidates` random lineups are.
+
+    Returns the indices of each team and the match quality.
+    """
+    if not 1 <= team_size <= MAX_TEAM_SIZE:
+        raise ValueError(f"Team size must be between 1 and {MAX_TEAM_SIZE}, got {team_size}")
+    if n_candidates < 1:
+        raise ValueError(f"Need at least 1 candidate, got {n_candidates}")
+    n_models = len(mu)
+    free_slots = 2 * team_size - 1
+    n_candidates = min(n_candidates, MAX_CANDIDATES)
+    if n_models ** free_slots <= n_candidates:
+        lineups = np.indices((n_models,) * free_slots).reshape(free_slots, -1).T
+    else:
+        lineups = rng.integers(0, n_models, size=(n_candidates, free_slots))
+    team0 = np.concatenate([np.zeros((len(lineups), 1), dtype=lineups.dtype), lineups[:, :team_size - 1]], axis=1)
+    team1 = lineups[:, team_size - 1:]
+
+    qualities = match_quality(mu, sigma, team0, team1, global_env().beta)
+    mirrored = (team0[:, :, None] == team1[:, None, :]).any(axis=(1, 2))
+    best = int(np.argmax(qualities - mirrored))
+    return team0[best].tolist(), team1[best].tolist(), float(qualities[best])
@@ -0,0 +1,211 @@
+"""
+Node-local caching proxy for the R^3 server, so env processes on a node share one set of requests
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin
+
+from flask import Flask, Response, request
+import requests
+
+# Hop-by-hop and length headers are recomputed by the proxy
+_SKIPPED_HEADERS = {'connection', 'content-encoding', 'content-length', 'keep-alive', 'transfer-encoding'}
+# Responses that can change when any model's rating or checkpoint does, not just the ones they mention
+_RATING_PATHS = frozenset({'/leaderboard'})
+_MODEL_PATHS = frozenset({'/models', '/models/latest', '/leaderboard'})
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    headers: Tuple[Tuple[str, str], ...]
+    body: bytes
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Optional[CachedResponse] = None
+        self.error: Optional[Exception] = None
+
+
+class ResponseCache:
+    """
+    TTL cache of upstream responses with single-flight fetching: while a key is being fetched,
+    other requests for it wait for that fetch instead of making their own.
+
+    Keys start with the request path. Each entry remembers the model ids in its response, so writes
+    only invalidate the entries they affect.
+    """
+    def __init__(self, max_entries: int=4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: "OrderedDict[tuple, Tuple[float, CachedResponse, FrozenSet[str]]]" = OrderedDict()
+        self._in_flight: Dict[tuple, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key: tuple, ttl: float, fetch) -> CachedResponse:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                # Server errors aren't cached, the next request retries
+                if flight.response is not None and flight.response.status < 500 and ttl > 0:
+                    self._entries[key] = (time.monotonic() + ttl, flight.response, _model_ids(flight.response))
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return flight.response
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate(self, model_ids: Iterable[str]=(), paths: Iterable[str]=()) -> None:
+        """
+        Drops entries whose response mentions any of `model_ids`, and entries for any of `paths`.
+        """
+        model_ids = set(model_ids)
+        paths = set(paths)
+        with self._lock:
+            stale = [key for key, (_, _, mentioned) in self._entries.items() if key[0] in paths or not model_ids.isdisjoint(mentioned)]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "entries": len(self._entries)}
+
+
+def create_proxy_app(upstream: str, ttl: float=5., max_entries: int=4096) -> Flask:
+    """
+    An app with the same API as the server, forwarding to `upstream`.
+
+    Model reads and the leaderboard are cached for `ttl` seconds, and identical reads in flight at
+    once are coalesced. /ts/opponents and /ts/match are random samples, so they're always forwarded,
+    or every worker on the node would play the same opponents. Writes are forwarded too, and
+    invalidate the cached responses they change so a worker sees its own changes.
+    """
+    app = Flask(__name__)
+    cache = ResponseCache(max_entries)
+    local = threading.local()
+    app.extensions['rcubed_proxy_cache'] = cache
+
+    def session() -> requests.Session:
+        # One pooled connection set per request thread
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def forward() -> CachedResponse:
+        r = session().request(
+            request.method,
+            urljoin(upstream, request.full_path if request.query_string else request.path),
+            data=request.get_data(),
+            headers={k: v for k, v in request.headers.items() if k.lower() not in _SKIPPED_HEADERS | {'host'}},
+        )
+        headers = tuple((k, v) for k, v in r.headers.items() if k.lower() not in _SKIPPED_HEADERS)
+        return CachedResponse(r.status_code, headers, r.content)
+
+    def respond(cached: CachedResponse) -> Response:
+        return Response(cached.body, status=cached.status, headers=list(cached.headers))
+
+    @app.get('/proxy/stats')
+    def get_stats():
+        return cache.stats()
+
+    @app.route('/models', methods=['GET'])
+    @app.route('/models/<path:_>', methods=['GET'])
+    @app.route('/leaderboard', methods=['GET'])
+    def cached_read(_=None):
+        key = (request.path, request.query_string)
+        return respond(cache.get_or_fetch(key, ttl, forward))
+
+    @app.post('/ts/opponents')
+    @app.post('/ts/match')
+    def uncached_sample():
+        # Every worker needs its own sample
+        return respond(forward())
+
+    @app.post('/ts/result')
+    @app.post('/ts/results')
+    def rate():
+        response = forward()
+        if response.status < 400:
+            cache.invalidate(_rated_ids(request.get_json(silent=True)), _RATING_PATHS)
+        return respond(response)
+
+    @app.route('/<path:_>', methods=['POST', 'PATCH', 'PUT', 'DELETE'])
+    def write(_):
+        response = forward()
+        if response.status < 400:
+            if request.path.startswith('/models/'):
+                model_id = request.path[len('/models/'):]
+                cache.invalidate([model_id], _MODEL_PATHS | {request.path})
+            elif request.path == '/models':
+                # A new checkpoint, which can only show up in listings. Its own path may hold a cached 404
+                created = json.loads(response.body).get('id') if response.status == 201 else None
+                cache.invalidate((), _MODEL_PATHS | ({f'/models/{created}'} if created else set()))
+            else:
+                cache.clear()
+        return respond(response)
+
+    return app
+
+
+def _model_ids(response: CachedResponse) -> FrozenSet[str]:
+    # Ids of every model record in a response, however deeply nested
+    try:
+        body = json.loads(response.body)
+    except ValueError:
+        return frozenset()
+    ids = set()
+    pending = [body]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            if isinstance(value.get('id'), str):
+                ids.add(value['id'])
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+    return frozenset(ids)
+
+
+def _rated_ids(body) -> Iterable[str]:
+    # Every model in the submitted results. Malformed results weren't rated, so skipping them is safe
+    results = body['results'] if isinstance(body, dict) and 'results' in body else [body]
+    for result in results:
+        try:
+            yield from result['match']['team0'] + result['match']['team1']
+        except (KeyError, TypeError):
+            continue
@@ -0,0 +1,157 @@
+"""
+In-memory index of model ratings, so matchmaking doesn't scan and sort the model table
+"""
+from bisect import bisect_left, bisect_right, insort
+from heapq import merge
+from itertools import islice
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from rcubed.server.db import RCubedDB
+
+# (botName, runName)
+GroupKey = Tuple[str, str]
+# (-score, id), the sort key of the leaderboard
+LeaderboardKey = Tuple[float, str]
+
+
+class _Group:
+    def __init__(self):
+        # Both kept sorted, ties broken by id so entries can be found again for removal
+        self.by_mu: List[Tuple[float, str]] = []
+        self.by_sigma: List[Tuple[float, str]] = []  # (-sigma, id), largest sigma first
+        self.by_score: List[LeaderboardKey] = []  # (-(mu - k * sigma), id), best first
+
+
+class RatingIndex:
+    """
+    Sorted views of every model's mu and sigma, grouped by bot and run name.
+
+    Queries are a binary search per group in the filter followed by a k-way merge, so they cost
+    O(groups * log n + k log groups) regardless of how many checkpoints there are. The index lives
+    in the server process, so every rating write must go through `refresh` to keep it in step
+    with the database.
+
+    The leaderboard is kept sorted by the conservative skill estimate mu - k * sigma, for the k
+    given here, so ranking pages cost the same as the other queries.
+    """
+    def __init__(self, leaderboard_k: float=3.):
+        self.leaderboard_k = leaderboard_k
+        self.lock = threading.RLock()
+        self._groups: Dict[GroupKey, _Group] = {}
+        # id -> (group, mu, sigma)
+        self._entries: Dict[str, Tuple[GroupKey, float, float]] = {}
+
+    def load(self, db: RCubedDB) -> None:
+        with self.lock:
+            self._groups.clear()
+            self._entries.clear()
+            for model_id, bot_name, run_name, mu, sigma in db.get_ratings():
+                self._insert(model_id, (bot_name, run_name), mu, sigma)
+
+    def refresh(self, db: RCubedDB, model_ids: List[str]) -> None:
+        """
+        Re-reads the given models after they were written. Ids that no longer exist are removed.
+        Reading under the lock means the last refresh always sees the last committed write.
+        """
+        with self.lock:
+            models = db.get_models_by_ids(model_ids)
+            for model_id in set(model_ids):
+                self._remove(model_id)
+                model = models.get(model_id)
+                if model is not None:
+                    self._insert(model_id, (model["botName"], model["runName"]), model["ts"]["mu"], model["ts"]["sigma"])
+
+    def get_by_mu(self, mu: float, model_filter: Dict[str, List[str]], limit=50) -> List[Tuple[str, float, float, float]]:
+        """
+        Same results as RCubedDB.get_by_mu: (id, dmu, mu, sigma) for the `limit` models closest to `mu`.
+        """
+        with self.lock:
+            nearest = merge(*(self._nearest(group, mu) for group in self._filter_groups(model_filter)))
+            return [(model_id, dmu, m_mu, self._entries[model_id][2]) for dmu, m_mu, model_id in islice(nearest, limit)]
+
+    def get_by_sigma(self, model_filter: Dict[str, List[str]], limit=10) -> List[Tuple[str, float, float]]:
+        """
+        Same results as RCubedDB.get_by_sigma: (id, mu, sigma) for the `limit` models with the highest sigma.
+        """
+        with self.lock:
+            highest = merge(*(group.by_sigma for group in self._filter_groups(model_filter)))
+            return [(model_id, self._entries[model_id][1], -neg_sigma) for neg_sigma, model_id in islice(highest, limit)]
+
+    def get_leaderboard(self, bot: Optional[str]=None, run: Optional[str]=None, after: Optional[LeaderboardKey]=None, limit=50) -> Tuple[List[Tuple[int, str, str, str, float, float, float]], Optional[LeaderboardKey]]:
+        """
+        A page of (rank, id, botName, runName, mu, sigma, score), best score first, optionally
+        filtered by bot and run name. Ranks are 1-based within the filter. `after` is the cursor
+        returned with the previous page, and the returned cursor is None on the last page.
+        """
+        with self.lock:
+            groups = [
+                (key, group) for key, group in self._groups.items()
+                if (bot is None or key[0] == bot) and (run is None or key[1] == run)
+            ]
+            starts = [0 if after is None else bisect_right(group.by_score, after) for _, group in groups]
+            # Everything before the cursor in each group ranks higher
+            rank = sum(starts)
+            ranked = merge(*(
+                ((neg_score, model_id, key) for neg_score, model_id in islice(group.by_score, start, None))
+                for (key, group), start in zip(groups, starts)
+            ))
+            page = []
+            for neg_score, model_id, key in islice(ranked, limit + 1):
+                rank += 1
+                _, mu, sigma = self._entries[model_id]
+                page.append((rank, model_id, key[0], key[1], mu, sigma, -neg_score))
+        if len(page) > limit:
+            page = page[:limit]
+            return page, (-page[-1][6], page[-1][1])
+        return page, None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _filter_groups(self, model_filter: Dict[str, List[str]]) -> List[_Group]:
+        groups = []
+        for bot_name, run_names in model_filter.items():
+            for run_name in set(run_names):
+                group = self._groups.get((bot_name, run_name))
+                if group is not None:
+                    groups.append(group)
+        return groups
+
+    @staticmethod
+    def _nearest(group: _Group, mu: float) -> Iterator[Tuple[float, float, str]]:
+        # Walks outwards from mu, yielding (dmu, mu, id) in increasing distance
+        by_mu = group.by_mu
+        hi = bisect_left(by_mu, (mu, ''))
+        lo = hi - 1
+        while lo >= 0 or hi < len(by_mu):
+            if hi >= len(by_mu) or (lo >= 0 and mu - by_mu[lo][0] <= by_mu[hi][0] - mu):
+                m_mu, model_id = by_mu[lo]
+                lo -= 1
+            else:
+                m_mu, model_id = by_mu[hi]
+                hi += 1
+            yield abs(m_mu - mu), m_mu, model_id
+
+    def _score_key(self, mu: float, sigma: float) -> float:
+        # Negated so the best score sorts first
+        return -(mu - self.leaderboard_k * sigma)
+
+    def _insert(self, model_id: str, key: GroupKey, mu: float, sigma: float) -> None:
+        group = self._groups.setdefault(key, _Group())
+        insort(group.by_mu, (mu, model_id))
+        insort(group.by_sigma, (-sigma, model_id))
+        insort(group.by_score, (self._score_key(mu, sigma), model_id))
+        self._entries[model_id] = (key, mu, sigma)
+
+    def _remove(self, model_id: str) -> None:
+        entry = self._entries.pop(model_id, None)
+        if entry is None:
+            return
+        key, mu, sigma = entry
+        group = self._groups[key]
+        del group.by_mu[bisect_left(group.by_mu, (mu, model_id))]
+        del group.by_sigma[bisect_left(group.by_sigma, (-sigma, model_id))]
+        del group.by_score[bisect_left(group.by_score, (self._score_key(mu, sigma), model_id))]
+        if len(group.by_mu) == 0:
+            del self._groups[key]
@@ -0,0 +1,139 @@
+"""
+Closed form TrueSkill updates for two team matches, and replay of the match log to rebuild every rating
+"""
+from functools import lru_cache
+from math import erfc, exp, pi, sqrt
+from statistics import NormalDist
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from trueskill import TrueSkill, global_env
+
+from rcubed.server.db import RCubedDB
+
+_SQRT2 = sqrt(2)
+_SQRT2PI = sqrt(2 * pi)
+
+
+def _v_w_win(x: float) -> Tuple[float, float]:
+    # Mean and variance corrections for a win with performance difference x, as in trueskill's v_win/w_win
+    cdf = 0.5 * erfc(-x / _SQRT2)
+    v = exp(-x * x / 2) / _SQRT2PI / cdf if cdf else -x
+    # Only leaves [0, 1] through rounding on extreme upsets, where trueskill raises instead
+    w = min(max(v * (v + x), 0.), 1.)
+    return v, w
+
+
+@lru_cache(maxsize=64)
+def _draw_margin(draw_probability: float, n_players: int, beta: float) -> float:
+    # Same as trueskill.calc_draw_margin, cached as it's the same for every match of a size
+    return NormalDist().inv_cdf((draw_probability + 1) / 2.) * sqrt(n_players) * beta
+
+
+def rate_two_teams(
+    ratings: Dict[str, Tuple[float, float]],
+    team0: List[str],
+    team1: List[str],
+    team0_won: bool,
+    env: TrueSkill,
+    fixed: Iterable[str]=(),
+) -> Dict[str, Tuple[float, float]]:
+    """
+    New (mu, sigma) of every model in the match, except those in `fixed`.
+
+    Two teams joined by one comparison need no message passing, so this is the exact update
+    trueskill's factor graph converges to. It matches `trueskill.rate` when every model plays
+    once. A model in several slots is rated as one skill playing k cars: it adds k * mu to its
+    team's performance and gets k times the update, rather than k separate updates averaged.
+    """
+    tau2 = env.tau ** 2
+    beta2 = env.beta ** 2
+    # Slots per model, with a sign for the team
+    counts: Dict[str, int] = {}
+    for model_id in team0:
+        counts[model_id] = counts.get(model_id, 0) + 1
+    for model_id in team1:
+        counts[model_id] = counts.get(model_id, 0) - 1
+    n_players = len(team0) + len(team1)
+
+    diff = 0.
+    c2 = n_players * beta2
+    for model_id, k in counts.items():
+        mu, sigma = ratings[model_id]
+        diff += k * mu
+        c2 += k * k * (sigma * sigma + tau2)
+    if not team0_won:
+        diff = -diff
+    c = sqrt(c2)
+    v, w = _v_w_win((diff - _draw_margin(env.draw_probability, n_players, env.beta)) / c)
+
+    updated = {}
+    for model_id, k in counts.items():
+        if model_id in fixed or k == 0:
+            # Counts of 0 play for both teams equally, and learn nothing from the result
+            continue
+        mu, sigma = ratings[model_id]
+        var = sigma * sigma + tau2
+        sign = k if team0_won else -k
+        updated[model_id] = (mu + sign * var / c * v, sqrt(var * (1 - k * k * var / c2 * w)))
+    return updated
+
+
+def replay(
+    initial: Dict[str, Tuple[float, float]],
+    matches: Iterable[Tuple[int, List[str], List[str], int]],
+    anchor: Optional[str],
+    env: Optional[TrueSkill]=None,
+    inheritance: Iterable[Tuple[int, str, str]]=(),
+) -> Dict[str, Tuple[float, float]]:
+    """
+    Rates (id, team0, team1, result) matches in id order from the `initial` ratings, entirely in memory.
+    Models missing from `initial` (e.g. deleted since) start at the env's default rating.
+    The anchor is never updated.
+
+    `inheritance` is (last match id, child, parent) sorted by match id, as from RCubedDB.get_inheritance.
+    Each child takes its parent's replayed rating once every match up to that id has been rated.
+    Children whose parent is gone keep their initial rating.
+    """
+    env = env or global_env()
+    if callable(env.draw_probability):
+        raise ValueError("Replays need a fixed draw probability")
+    default = (env.mu, env.sigma)
+    ratings = dict(initial)
+    fixed = (anchor,)
+    inheritance = iter(inheritance)
+    next_inherit = next(inheritance, None)
+    def inherit_before(match_id):
+        nonlocal next_inherit
+        while next_inherit is not None and (match_id is None or next_inherit[0] < match_id):
+            _, child, parent = next_inherit
+            if parent in ratings:
+                ratings[child] = ratings[parent]
+            next_inherit = next(inheritance, None)
+
+    for match_id, team0, team1, result in matches:
+        inherit_before(match_id)
+        for model_id in team0 + team1:
+            if model_id not in ratings:
+                ratings[model_id] = default
+        ratings.update(rate_two_teams(ratings, team0, team1, result == 0, env, fixed))
+    inherit_before(None)
+    return ratings
+
+
+def recompute(db: RCubedDB, env: Optional[TrueSkill]=None) -> int:
+    """
+    Rebuilds every rating from the initial ratings and the match log, then writes them back in one
+    transaction. Returns the number of matches replayed.
+    """
+    with db.transaction():
+        anchor = db.get_setting('ts_anchor')
+        initial = db.get_initial_ratings()
+        n_matches = 0
+        def counted(matches):
+            nonlocal n_matches
+            for match in matches:
+                n_matches += 1
+                yield match
+        ratings = replay(initial, counted(db.iter_matches()), anchor, env, db.get_inheritance())
+        db.update_ratings({model_id: rating for model_id, rating in ratings.items() if model_id in initial and model_id != anchor})
+    return n_matches
@@ -0,0 +1,33 @@
+"""
+Runs a Flask app with a multi-threaded production WSGI server
+"""
+import signal
+import sys
+
+from flask import Flask
+
+
+def serve(app: Flask, host: str, port: int, workers: int) -> None:
+    """
+    Serves `app` with waitress using `workers` request threads until SIGINT or SIGTERM.
+    In-flight requests are allowed to finish before returning.
+
+    Threads let requests overlap while they wait on sockets or SQLite, and keep the server's
+    in-memory state (like the rating index) consistent. Rating, Flask and JSON work still hold the
+    GIL, so this uses one core. Put several --proxy processes in front of it to spread the
+    read-heavy traffic instead.
+    """
+    try:
+        from waitress import create_server
+    except ImportError:
+        print("waitress is required to serve without --debug. Install it with `pip install waitress`")
+        exit(-1)
+
+    server = create_server(app, host=host, port=port, threads=workers)
+
+    # waitress drains its worker threads when the main loop is interrupted, so SIGTERM gets the
+    # same graceful shutdown as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server.print_listen("Serving on http://{}:{}")
+    server.run()
@@ -1,2 +1,3 @@
 from .v2wrapper import RCubed
+from .vecwrapper import VecRCubed
 from .opponent import Opponent
@@ -1,8 +1,11 @@
-from typing import Any, Dict
+from copy import copy
+from time import perf_counter_ns
+from typing import Any, Dict, Optional
 from rlgym.api import ActionParser, AgentID, ActionType, EngineActionType, StateType, SpaceType
 
-from rcubed.wrapper.common import BOT_MANAGER_KEY
+from rcubed.wrapper.common import BOT_MANAGER_KEY, PROFILER_KEY
 from rcubed.wrapper.botmanager import BotManager
+from rcubed.wrapper.profiling import StepProfiler
 
 class WrappedParser(ActionParser[AgentID, ActionType, EngineActionType, StateType, SpaceType]):
     def __init__(self, default: ActionParser):
@@ -11,11 +14,30 @@ class WrappedParser(ActionParser[AgentID, ActionType, EngineActionType, StateTyp
     def parse_actions(self, actions: Dict[AgentID, ActionType], state: StateType, shared_info: Dict[str, Any]) -> Dict[AgentID, EngineActionType]:
         parsed_actions = {}
         bot_manager: BotManager = shared_info[BOT_MANAGER_KEY]
-        for opp, ids in bot_manager.inv_mapping.items():
-            subset = opp.action_parser.parse_actions({k: actions[k] for k in actions.keys() if k in ids}, state, shared_info)
+        partition = bot_manager.partition
+        held_actions = bot_manager.held_actions
+        profiler: Optional[StepProfiler] = shared_info.get(PROFILER_KEY)
+        for opp, ids in partition.opponents:
+            holds = opp.decision_interval > 1
+            if holds:
+                # Agents without a new action replay the last one they were parsed
+                parsed_actions.update((agent, held_actions[agent]) for agent in ids if agent not in actions)
+                ids = [agent for agent in ids if agent in actions]
+                if not ids:
+                    continue
+            t0 = profiler and perf_counter_ns()
+            subset = opp.action_parser.parse_actions({agent: actions[agent] for agent in ids}, state, shared_info)
+            if profiler is not None:
+                profiler.record_opponent('parse', opp, t0)
+            if holds:
+                # Parsers may reuse their output buffers, so held actions are copies
+                held_actions.update((agent, copy(action)) for agent, action in subset.items())
             parsed_actions.update(subset)
-        
-        default_actions = self.default.parse_actions({k: actions[k] for k in actions.keys() if bot_manager.mapping[k] is None}, state, shared_info)
+
+        t0 = profiler and perf_counter_ns()
+        default_actions = self.default.parse_actions({agent: actions[agent] for agent in partition.learners}, state, shared_info)
+        if profiler is not None:
+            profiler.record('learner_parse', t0)
         parsed_actions.update(default_actions)
 
         return parsed_actions
@@ -27,7 +49,7 @@ class WrappedParser(ActionParser[AgentID, ActionType, EngineActionType, StateTyp
     
     def reset(self, initial_state: StateType, shared_info: Dict[str, Any]) -> None:
         bot_manager: BotManager = shared_info[BOT_MANAGER_KEY]
-        for opp in bot_manager.inv_mapping.keys():
+        for opp, _ in bot_manager.partition.opponents:
             opp.action_parser.reset(initial_state, shared_info)
         
         self.default.reset(initial_state, shared_info)
@@ -0,0 +1,50 @@
+"""
+Preallocated buffers for RCubed's array mode
+"""
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from rlgym.api import AgentID
+
+
+class AgentBuffers:
+    """
+    Contiguous buffers with one fixed slot per agent, reused for every step while the agents stay the same.
+    The arrays returned by the `write_*` methods are the buffers themselves, so they are overwritten by the
+    next step and should be copied if they need to be kept.
+    """
+    def __init__(self, agents: Tuple[AgentID, ...]):
+        self.agents = agents
+        # Allocated on the first write, once the observation shape is known
+        self.obs: Optional[np.ndarray] = None
+        self.rewards = np.zeros(len(agents), dtype=np.float64)
+        self.terminated = np.zeros(len(agents), dtype=bool)
+        self.truncated = np.zeros(len(agents), dtype=bool)
+        self.actions: Dict[AgentID, Any] = {}
+
+    def read_actions(self, actions: np.ndarray) -> Dict[AgentID, Any]:
+        """
+        Maps rows of `actions` to agents by slot. The rows are views, nothing is copied.
+        """
+        if not isinstance(actions, np.ndarray):
+            raise TypeError(f"Array mode takes actions as an array with one row per agent, got {type(actions).__name__}")
+        if len(actions) != len(self.agents):
+            raise ValueError(f"Expected actions for {len(self.agents)} agents, got {len(actions)}")
+        self.actions.clear()
+        self.actions.update(zip(self.agents, actions))
+        return self.actions
+
+    def write_obs(self, all_obs: Dict[AgentID, Any]) -> np.ndarray:
+        first = np.asarray(all_obs[self.agents[0]]) if self.agents else np.empty(0)
+        if self.obs is None or self.obs.shape[1:] != first.shape or self.obs.dtype != first.dtype:
+            self.obs = np.empty((len(self.agents), *first.shape), dtype=first.dtype)
+        for i, agent in enumerate(self.agents):
+            self.obs[i] = all_obs[agent]
+        return self.obs
+
+    def write_step(self, rewards: Dict[AgentID, Any], terminated: Dict[AgentID, bool], truncated: Dict[AgentID, bool]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        for i, agent in enumerate(self.agents):
+            self.rewards[i] = rewards[agent]
+            self.terminated[i] = terminated[agent]
+            self.truncated[i] = truncated[agent]
+        return self.rewards, self.terminated, self.truncated
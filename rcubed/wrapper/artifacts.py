@@ -0,0 +1,231 @@
+"""
+Node-local cache of model files, shared by every env process on the machine
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Iterator, Optional
+from urllib.parse import urlparse
+import zipfile
+
+import numpy as np
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking, so concurrent misses may download twice. Still safe as every write is atomic
+    fcntl = None
+
+# Location types the cache can fetch. Anything else is passed to the opponent untouched,
+# as are 'file' locations that aren't regular files, e.g. checkpoint directories
+CACHEABLE_TYPES = ('file', 'url')
+
+_CHUNK_SIZE = 1 << 20
+
+
+class ArtifactCache:
+    """
+    Copies model files into a directory on local disk, so each is downloaded once per node.
+
+    Files are stored once per content hash under `blobs/`, and `refs/` maps each model id and
+    location to its blob. Every file is written to a temporary name and renamed into place, so
+    readers never see a partial file, and processes fetching the same model wait for the first
+    one instead of downloading it again.
+
+    When the blobs exceed `max_bytes`, the least recently fetched are deleted. Processes that
+    already opened or mapped a deleted blob keep their copy until they close it.
+    """
+    def __init__(self, root: str, max_bytes: Optional[int]=None, session: Optional[requests.Session]=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.session = session if session is not None else requests.Session()
+        for sub in ('blobs', 'refs', 'tmp', 'locks'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    @staticmethod
+    def can_fetch(location: str, location_type: str) -> bool:
+        """
+        Whether `fetch` handles this location: URLs, and paths of regular files.
+        """
+        if location_type == 'file':
+            return os.path.isfile(location)
+        return location_type in CACHEABLE_TYPES
+
+    def fetch(self, model_id: str, location: str, location_type: str) -> str:
+        """
+        Returns the path of a local copy of the model's file, fetching it if needed.
+        """
+        if not self.can_fetch(location, location_type):
+            raise ValueError(f"Can't cache {location_type!r} location {location!r}, only URLs and regular files are cached")
+        ref = self._ref_key(model_id, location, location_type)
+        path = self._lookup(ref)
+        if path is not None:
+            return path
+
+        with self._locked(ref):
+            # Another process may have fetched it while we waited for the lock
+            path = self._lookup(ref)
+            if path is not None:
+                return path
+            path = self._populate(ref, location, location_type)
+        self._evict(keep=path)
+        return path
+
+    def _lookup(self, ref: str) -> Optional[str]:
+        try:
+            with open(self._ref_path(ref)) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        path = self._blob_path(meta["sha256"], meta["ext"])
+        try:
+            # mtime marks recent use for eviction, atime isn't reliably updated
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted, the ref is stale
+            return None
+        return path
+
+    def _populate(self, ref: str, location: str, location_type: str) -> str:
+        ext = os.path.splitext(urlparse(location).path if location_type == 'url' else location)[1]
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self._read(location, location_type):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = sha256.hexdigest()
+            path = self._blob_path(digest, ext)
+            # Identical content from another model is already in place
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                os.utime(path)
+            else:
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._write_atomic(self._ref_path(ref), json.dumps({"sha256": digest, "ext": ext, "size": size}))
+        return path
+
+    def _read(self, location: str, location_type: str) -> Iterator[bytes]:
+        if location_type == 'file':
+            with open(location, 'rb') as f:
+                while chunk := f.read(_CHUNK_SIZE):
+                    yield chunk
+        else:
+            with self.session.get(location, stream=True) as r:
+                r.raise_for_status()
+                yield from r.iter_content(_CHUNK_SIZE)
+
+    def _evict(self, keep: str) -> None:
+        if self.max_bytes is None:
+            return
+        blobs_dir = os.path.join(self.root, 'blobs')
+        blobs = []
+        for entry in os.scandir(blobs_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another process, or open on a platform that won't delete open files
+                continue
+            total -= size
+
+    def _write_atomic(self, path: str, content: str) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, 'tmp'))
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    @contextmanager
+    def _locked(self, ref: str):
+        if fcntl is None:
+            yield
+            return
+        path = os.path.join(self.root, 'locks', ref)
+        while True:
+            f = open(path, 'w')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # The previous holder removes the file before unlocking, so a lock on a file that is no
+            # longer at `path` guards nothing, and we retry with a fresh one
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        try:
+            yield
+        finally:
+            # Removed while still held, so lock files don't pile up with one per model
+            os.remove(path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    @staticmethod
+    def _ref_key(model_id: str, location: str, location_type: str) -> str:
+        # Model ids come from the server as UUIDs, the location hash makes a moved model a new entry
+        location_hash = hashlib.sha256(f'{location_type}:{location}'.encode()).hexdigest()[:16]
+        return f'{model_id}-{location_hash}'
+
+    def _ref_path(self, ref: str) -> str:
+        return os.path.join(self.root, 'refs', ref + '.json')
+
+    def _blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, 'blobs', digest + ext)
+
+
+def load_arrays(path: str) -> Dict[str, np.ndarray]:
+    """
+    Opens a .npy or .npz file as read-only arrays backed by the page cache, so every process that
+    loads the same file shares one copy in memory. A .npy file gives a single array under ''.
+
+    Members of a .npz saved with `np.savez` are mapped in place. Compressed members
+    (`np.savez_compressed`) can't be, and are read into memory instead.
+    """
+    if not zipfile.is_zipfile(path):
+        return {'': np.load(path, mmap_mode='r')}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # The local header repeats the name and has its own extra field before the data
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(name_len) + int(extra_len))
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"{info.filename} in {path} holds Python objects, which can't be memory mapped")
+            if int(np.prod(shape)) == 0:
+                # Nothing to map
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(f.name, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return arrays
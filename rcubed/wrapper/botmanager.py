@@ -1,18 +1,68 @@
 """
 This is for dealing with loading/unloading of bots
 """
-from typing import Dict, Optional, List, Type
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional, List, Tuple, Type
 import requests
 from urllib.parse import urljoin
 import random
+import threading
+import weakref
 
+import numpy as np
 from rlgym.api import AgentID
 
+from rcubed.wrapper.artifacts import ArtifactCache
+from rcubed.wrapper.inference import InferenceClient
+from rcubed.wrapper.modelcache import ModelCache
 from rcubed.wrapper.opponent import Opponent
 
+class MatchPartition(NamedTuple):
+    """
+    Which agents belong to the learner and to each opponent for the current match.
+    Built once per match so the per-step routing doesn't have to search the mapping.
+    """
+    agents: Tuple[AgentID, ...]
+    learners: Tuple[AgentID, ...]
+    opponent_agents: Tuple[AgentID, ...]
+    opponents: Tuple[Tuple[Opponent, Tuple[AgentID, ...]], ...]
+    # Agents of opponents with the same obs_builder_key, with the opponent whose builder they use
+    obs_groups: Tuple[Tuple[Opponent, Tuple[AgentID, ...]], ...]
+
+    @classmethod
+    def from_mapping(cls, agents: List[AgentID], mapping: Dict[AgentID, Optional[Opponent]]) -> "MatchPartition":
+        opp_agents: Dict[Opponent, List[AgentID]] = {}
+        for agent in agents:
+            if mapping[agent] is not None:
+                opp_agents.setdefault(mapping[agent], []).append(agent)
+        obs_groups: Dict[Hashable, Tuple[Opponent, List[AgentID]]] = {}
+        for opp, ids in opp_agents.items():
+            key = opp.obs_builder_key
+            # Without a key the builder is the opponent's own
+            obs_groups.setdefault(opp if key is None else key, (opp, []))[1].extend(ids)
+        return cls(
+            agents=tuple(agents),
+            learners=tuple(agent for agent in agents if mapping[agent] is None),
+            opponent_agents=tuple(agent for agent in agents if mapping[agent] is not None),
+            opponents=tuple((opp, tuple(ids)) for opp, ids in opp_agents.items()),
+            obs_groups=tuple((opp, tuple(ids)) for opp, ids in obs_groups.values()),
+        )
+
+def combined_filter(bots: List[Type[Opponent]]) -> Dict[str, List[str]]:
+    """
+    Merges the filters of several opponent classes.
+    """
+    model_filter: Dict[str, List[str]] = {}
+    for opp in bots:
+        for bot, runs in opp.get_filter().items():
+            existing_entry = model_filter.get(bot, [])
+            model_filter[bot] = [*existing_entry, *runs]
+    return model_filter
+
 class BotManager:
     mapping: Dict[AgentID, Optional[Opponent]]
     inv_mapping: Dict[Opponent, List[AgentID]]
+    partition: MatchPartition
     bots: List[Type[Opponent]]
     loaded_models: List[Opponent]
     def __init__(self,
@@ -20,97 +70,292 @@ class BotManager:
                  base_url: str,
                  bot_name: str=None,
                  run_name: str=None,
+                 background_refresh: bool=False,
+                 model_cache: Optional[ModelCache]=None,
+                 inference_client: Optional[InferenceClient]=None,
+                 artifact_cache: Optional[ArtifactCache]=None,
                  ):
         self.opponent_chance = opponent_chance
         self.bots = []
         self.mapping = {}
         self.inv_mapping = {}
+        self.partition = MatchPartition.from_mapping([], {})
+        # Action holds of agents whose opponent has a decision interval, cleared every match
+        self.held_actions: Dict[AgentID, Any] = {}
+        self._hold_steps: Dict[AgentID, int] = {}
+        self._decision_obs: Dict[AgentID, Any] = {}
         self.base_url = base_url
         self.bot_name = bot_name
         self.run_name = run_name
+        # Keeps connections to the server alive between requests
+        self.session = requests.Session()
         self.loaded_models = []
+        self.model_cache = model_cache if model_cache is not None else ModelCache()
+        # Loads opponents into a shared inference process instead of this one
+        self.inference_client = inference_client
+        # Model files are fetched into this node-local cache, and opponents load them as 'file' locations
+        self.artifact_cache = artifact_cache
+        # Server records of loaded opponents, for labels. Rolls re-read them for current ratings
+        self._records: "weakref.WeakKeyDictionary[Opponent, dict]" = weakref.WeakKeyDictionary()
+        # Background refreshes build the next pool here, and it is swapped in by swap_opponents
+        self.background_refresh = background_refresh
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._refresh_running = False
+        # Refreshes and rolls requested while one is running, run once it finishes
+        self._queued: List[Tuple[Callable[..., List[Opponent]], tuple]] = []
+        self._pending_lock = threading.Lock()
+        self._pending_models: Optional[List[Opponent]] = None
+        self._pending_error: Optional[Exception] = None
 
     def register(self, bot: Type[Opponent]):
         self.bots.append(bot)
 
+    def share_resources(self, other: "BotManager") -> None:
+        """
+        Uses `other`'s server session, caches and inference client instead of this manager's own,
+        for managers that only map matches from a pool `other` loads.
+        """
+        self.session = other.session
+        self.model_cache = other.model_cache
+        self.inference_client = other.inference_client
+        self.artifact_cache = other.artifact_cache
+
     def map_match(self, agents: List[AgentID]) -> None:
-        # We want to use probs here, then set _mapping and _inv_mapping
-        self.mapping.clear()
-        self.inv_mapping.clear()
         # First agent is always the training agent
-        self.mapping[agents[0]] = None
+        mapping = {agents[0]: None}
         for agent in agents[1:]:
             if random.random() < self.opponent_chance:
-                self.mapping[agent] = random.choice(self.loaded_models)
-                self.inv_mapping[self.mapping[agent]] = self.inv_mapping.get(self.mapping[agent], []) + [agent]
+                mapping[agent] = random.choice(self.loaded_models)
             else:
-                self.mapping[agent] = None
+                mapping[agent] = None
+        self.assign(agents, mapping)
+
+    def assign(self, agents: List[AgentID], mapping: Dict[AgentID, Optional[Opponent]]) -> None:
+        """
+        Sets which opponent controls each agent (None for the learner) for the next match.
+        """
+        self.mapping = mapping
+        self.partition = MatchPartition.from_mapping(agents, mapping)
+        self.inv_mapping = {opp: list(ids) for opp, ids in self.partition.opponents}
+        self.held_actions = {}
+        self._hold_steps = {}
+        self._decision_obs = {}
+
+    def deciding_agents(self, opp: Opponent, ids: Tuple[AgentID, ...], obs: Dict[AgentID, Any]) -> Tuple[AgentID, ...]:
+        """
+        Which of `opp`'s agents should get a new action this step, given their observations.
+        Call once per step. Held agents are left out, and their last parsed action is replayed.
+        """
+        interval = opp.decision_interval
+        if interval <= 1:
+            return ids
+        threshold = opp.obs_change_threshold
+        deciding = []
+        for agent in ids:
+            steps_left = self._hold_steps.get(agent, 0) - 1
+            if (
+                steps_left <= 0
+                or agent not in self.held_actions
+                or (threshold is not None and np.max(np.abs(np.asarray(obs[agent]) - self._decision_obs[agent])) > threshold)
+            ):
+                deciding.append(agent)
+                steps_left = interval
+                if threshold is not None:
+                    self._decision_obs[agent] = np.array(obs[agent])
+            self._hold_steps[agent] = steps_left
+        return tuple(deciding)
 
     def refresh_opponents(self, n=5) -> None:
         """
         Used to fetch a new set of opponents from the server, to use until this method is called again.
+
+        With background_refresh set, the new pool is fetched and loaded on a separate thread once there
+        is a pool to keep training against, and only becomes active when swap_opponents is called.
         """
-            
-        req_body = {
-            "bots": {},
-            "numOpponents": n,
-            "for": {
-                "mu": 25,
-                "sigma": 8.333
-            }
-        }
+        if not self.background_refresh or len(self.loaded_models) == 0:
+            self.loaded_models = self._fetch_opponents(n)
+            return
+
+        self._start_background(self._fetch_opponents, n)
+
+    def roll_opponents(self, k: int, pool_size: int) -> None:
+        """
+        Replaces the `k` opponents furthest in rating from the learner with new ones from the server,
+        keeping the rest of the pool. A pool smaller than `pool_size` is filled up instead.
+        As the learner's rating moves, the opponents it has outgrown are the ones that get replaced.
+
+        With background_refresh set, the new opponents are loaded on a separate thread and swapped in
+        by swap_opponents. A roll requested while another is loading runs once it finishes, on top of
+        the pool it loaded, so rolls always build on each other.
+        """
+        self.swap_opponents()
+        if not self.background_refresh or len(self.loaded_models) == 0:
+            self.loaded_models = self._rolled_pool(k, pool_size)
+            return
 
+        self._start_background(self._rolled_pool, k, pool_size)
+
+    def swap_opponents(self) -> bool:
+        """
+        Swaps in the pool loaded by a background refresh, if one is ready.
+        Returns whether the pool changed. Errors from the background refresh are raised here.
+        """
+        with self._pending_lock:
+            models, self._pending_models = self._pending_models, None
+            error, self._pending_error = self._pending_error, None
+        if error is not None:
+            raise error
+        if models is None:
+            return False
+        self.loaded_models = models
+        return True
+
+    def _start_background(self, fetch: Callable[..., List[Opponent]], *args) -> None:
+        with self._pending_lock:
+            if self._refresh_running:
+                self._queue(fetch, args)
+                return
+            self._refresh_running = True
+        self._refresh_thread = threading.Thread(target=self._fetch_in_background, args=(fetch, *args), daemon=True)
+        self._refresh_thread.start()
+
+    def _queue(self, fetch: Callable[..., List[Opponent]], args: tuple) -> None:
+        # Called with the pending lock held
+        if fetch == self._fetch_opponents:
+            # A new pool replaces everything requested before it
+            self._queued = [(fetch, args)]
+        elif self._queued and self._queued[-1][0] == self._rolled_pool:
+            # Rolls waiting together are one larger roll, so the queue can't outgrow the pool
+            (k, pool_size), (more_k, _) = self._queued[-1][1], args
+            self._queued[-1] = (fetch, (min(k + more_k, pool_size), pool_size))
+        else:
+            self._queued.append((fetch, args))
+
+    def _fetch_in_background(self, fetch: Callable[..., List[Opponent]], *args) -> None:
+        while True:
+            try:
+                models = fetch(*args)
+            except Exception as e:
+                with self._pending_lock:
+                    # Raised by the next swap_opponents, anything queued behind it is dropped with it
+                    self._pending_error = e
+                    self._queued = []
+                    self._refresh_running = False
+                return
+            with self._pending_lock:
+                self._pending_models = models
+                if not self._queued:
+                    self._refresh_running = False
+                    return
+                fetch, args = self._queued.pop(0)
+
+    def _current_pool(self) -> List[Opponent]:
+        # The newest pool, including one loaded in the background that hasn't been swapped in yet
+        with self._pending_lock:
+            return self._pending_models if self._pending_models is not None else self.loaded_models
+
+    def _rolled_pool(self, k: int, pool_size: int) -> List[Opponent]:
+        rating = self._own_rating()
+        current = self._current_pool()
+        distances = {opp: self._rating_distance(opp, rating["mu"]) for opp in current}
+        current = sorted(current, key=distances.__getitem__)
+        n_keep = len(current) if len(current) < pool_size else max(0, pool_size - k)
+        # Everything already loaded is excluded, so evicted opponents don't come straight back
+        fetched = self._fetch_opponents(pool_size - n_keep, rating, exclude=[
+            self._records[opp]["id"] for opp in current if opp in self._records
+        ])
+        pool = current[:n_keep] + fetched
+        # If the server ran out of other models, the closest evicted ones are better than a smaller pool
+        pool.extend(current[n_keep:][:pool_size - len(pool)])
+        return pool
+
+    def _rating_distance(self, opp: Opponent, mu: float) -> float:
+        # Re-read, as the rating the opponent was loaded with goes stale while matches are played
+        record = self._records.get(opp)
+        if record is None:
+            return float('inf')
+        r = self.session.get(urljoin(self.base_url, f'/models/{record["id"]}'), headers={
+            'Accept': 'application/json'
+        })
+        if not r.ok:
+            # Deleted since it was loaded, so it goes first
+            return float('inf')
+        record = self._records[opp] = r.json()
+        if not record["ts"]:
+            return float('inf')
+        return abs(record["ts"]["mu"] - mu)
+
+    def _own_rating(self) -> dict:
         # If we have a bot and run name, we can find a better match
         if self.bot_name and self.run_name:
-            last_ts = self.get_own_model()["ts"]
-            if last_ts:
-                req_body["for"] = last_ts
+            own_model = self.get_own_model()
+            if own_model and own_model["ts"]:
+                return own_model["ts"]
+        return {
+            "mu": 25,
+            "sigma": 8.333
+        }
 
-        for opp in self.bots:
-            for bot, runs in opp.get_filter().items():
-                existing_entry = req_body["bots"].get(bot, [])
-                req_body["bots"][bot] = [*existing_entry, *runs]
+    def _fetch_opponents(self, n: int, rating: Optional[dict]=None, exclude: List[str]=()) -> List[Opponent]:
+        req_body = {
+            "bots": self.model_filter(),
+            "numOpponents": n,
+            "for": rating or self._own_rating(),
+        }
+        if exclude:
+            req_body["exclude"] = list(exclude)
+
+        # Ask for full model records to avoid fetching each model separately
+        req_body["expand"] = True
 
         patch_url = urljoin(self.base_url, '/ts/opponents')
-        r = requests.post(patch_url, json=req_body, headers={
+        r = self.session.post(patch_url, json=req_body, headers={
             'Accept': 'application/json'
         })
 
-        matched_ids: List[str] = r.json()
-        self.loaded_models.clear()
-        for m_id in matched_ids:
-            r = requests.get(urljoin(self.base_url, f'/models/{m_id}'))
-            model = r.json()
-            cls = next(b for b in self.bots if model["runName"] in b.get_filter().get(model["botName"], ()))
-            self.loaded_models.append(cls.load_from_location(
-                model["location"]["value"],
-                model["location"]["type"],
-                model["botName"],
-                model["runName"]
-            ))
-
-    def get_own_model(self) -> dict:
-        # Get models
-        models = []
-        page_num = 0
-        while True:
-            get_url = urljoin(self.base_url, '/models')
-            r = requests.get(get_url, params={
-                "page": page_num,
-                "bot": self.bot_name,
-                "run": self.run_name,
-            }, headers= {
-                'Accept': 'application/json'
-            })
-            resp_data = r.json()
-            for d in resp_data["data"]:
-                models.append(d)
-            
-            if "nextPage" in resp_data.keys():
-                page_num = resp_data["nextPage"]
-            else:
-                break
-        if len(models) == 0:
-            return None
-        return max(models, key=lambda m: (m.get("steps", 0), m["created"]))
+        matched_models: List[dict] = r.json()
+        return [self.load_model(model) for model in matched_models]
 
+    def model_filter(self) -> Dict[str, List[str]]:
+        """
+        Bot and run names matched by any registered opponent class, in the form the server expects.
+        """
+        return combined_filter(self.bots)
+
+    def load_model(self, model: dict) -> Opponent:
+        """
+        Loads a model record from the server with the registered class that matches it, through the model cache.
+        """
+        cls = next(b for b in self.bots if model["runName"] in b.get_filter().get(model["botName"], ()))
+        key = (model["id"], model["location"]["type"], model["location"]["value"])
+        opp = self.model_cache.get_or_load(key, lambda: self._load_uncached(cls, model))
+        self._records[opp] = model
+        return opp
+
+    def _load_uncached(self, cls: Type[Opponent], model: dict) -> Opponent:
+        location, location_type = model["location"]["value"], model["location"]["type"]
+        if self.artifact_cache is not None and self.artifact_cache.can_fetch(location, location_type):
+            location, location_type = self.artifact_cache.fetch(model["id"], location, location_type), 'file'
+        load = cls.load_from_location if self.inference_client is None else partial(self.inference_client.load, cls)
+        return load(location, location_type, model["botName"], model["runName"])
+
+    def opponent_label(self, opp: Opponent) -> str:
+        """
+        Human readable name of a loaded opponent, for logging.
+        """
+        model = self._records.get(opp)
+        if model is None:
+            return f"{type(opp).__name__}@{id(opp):x}"
+        return f'{model["botName"]}/{model["runName"]}/{model["id"]}'
+
+    def get_own_model(self) -> Optional[dict]:
+        get_url = urljoin(self.base_url, '/models/latest')
+        r = self.session.get(get_url, params={
+            "bot": self.bot_name,
+            "run": self.run_name,
+        }, headers= {
+            'Accept': 'application/json'
+        })
+        if r.status_code == 404:
+            return None
+        return r.json()
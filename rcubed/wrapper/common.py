@@ -1 +1,2 @@
-BOT_MANAGER_KEY = 'rcubed-bot-manager'
\ No newline at end of file
+BOT_MANAGER_KEY = 'rcubed-bot-manager'
+PROFILER_KEY = 'rcubed-profiler'
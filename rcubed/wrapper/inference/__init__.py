@@ -0,0 +1,406 @@
+"""
+Runs opponents in a separate inference process, shared by every env process on a node.
+
+Env processes write opponent observations into a shared memory buffer and read the actions back
+from another, so only small control messages go over the connection. The server keeps one copy of
+each opponent's weights no matter how many env processes use it, and batches the requests for
+the same opponent across env processes into one `act` call.
+
+Start a server with
+    python -m rcubed.wrapper.inference --address 127.0.0.1:5152
+and pass `opponent_inference_address='127.0.0.1:5152'` to RCubed.
+
+Clients send pickled opponent classes that the server loads, so anyone who can connect can run
+code on the server. The default authkey is public, and is only accepted on loopback addresses
+and unix sockets. Set your own in the RCUBED_INFERENCE_AUTHKEY environment variable to listen on
+anything else.
+"""
+import ipaddress
+import os
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Connection, Listener, Pipe, wait
+from multiprocessing.shared_memory import SharedMemory
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple, Type
+
+import numpy as np
+from rlgym.api import ActionParser, ActionType, AgentID, ObsBuilder, ObsType
+
+from rcubed.wrapper.modelcache import ModelCache
+from rcubed.wrapper.opponent import Opponent
+
+# Public, so only accepted for addresses other machines can't reach
+DEFAULT_AUTHKEY = b'rcubed'
+# Read by the server script, so the authkey doesn't show up in the process list
+AUTHKEY_ENV = 'RCUBED_INFERENCE_AUTHKEY'
+
+# (class, location, location type, bot name, run name), everything needed to load an opponent
+LoadSpec = Tuple[Type[Opponent], str, str, str, str]
+# The same with the class by name, which is equal across processes
+ModelKey = Tuple[str, str, str, str, str]
+
+
+def _attach(name: str) -> SharedMemory:
+    shm = SharedMemory(name=name)
+    # Before 3.13 attaching registers the segment with this process' resource tracker, which
+    # would unlink it when the server exits even though the client owns it
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+class _ClientState:
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.obs_buf: Optional[SharedMemory] = None
+        self.action_buf: Optional[SharedMemory] = None
+
+    def close(self):
+        for buf in (self.obs_buf, self.action_buf):
+            if buf is not None:
+                buf.close()
+        self.conn.close()
+
+
+class InferenceServer:
+    """
+    Serves opponent inference to any number of InferenceClients.
+
+    Opponents are loaded on request and kept in a ModelCache. Each round, every pending `act`
+    request is grouped by opponent and the group is acted on in a single call, with keys of
+    (client, row) so opponents see one large batch.
+    """
+    def __init__(self, address, authkey: bytes=DEFAULT_AUTHKEY, max_models: int=32, max_bytes: Optional[int]=None):
+        if authkey == DEFAULT_AUTHKEY and not _is_local(address):
+            raise ValueError(f"Listening on {address} needs an authkey other than the default, which is public")
+        self.address = address
+        self.authkey = authkey
+        self.model_cache = ModelCache(max_models=max_models, max_bytes=max_bytes)
+        self.specs: Dict[ModelKey, LoadSpec] = {}
+        self._clients: Dict[Connection, _ClientState] = {}
+        self._new_lock = threading.Lock()
+        self._new_conns: List[Connection] = []
+        self._wake_r, self._wake_w = Pipe(duplex=False)
+
+    def serve_forever(self) -> None:
+        with Listener(self.address, authkey=self.authkey) as listener:
+            # Listener.address is the bound one, which matters when binding to port 0
+            self.address = listener.address
+            threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+            while True:
+                self._round()
+
+    def _accept(self, listener: Listener) -> None:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # Failed handshakes shouldn't stop the server
+                continue
+            with self._new_lock:
+                self._new_conns.append(conn)
+            self._wake_w.send(None)
+
+    def _round(self) -> None:
+        ready = wait([self._wake_r, *self._clients])
+        acts: List[Tuple[_ClientState, ModelKey, Tuple[int, ...], str]] = []
+        for conn in ready:
+            if conn is self._wake_r:
+                self._wake_r.recv()
+                with self._new_lock:
+                    new_conns, self._new_conns = self._new_conns, []
+                for new_conn in new_conns:
+                    self._clients[new_conn] = _ClientState(new_conn)
+                continue
+
+            client = self._clients[conn]
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                self._drop(client)
+                continue
+            except Exception as e:
+                # Read in full but couldn't be unpickled, e.g. an opponent class this process can't
+                # import. The connection is still in step, so only this request fails
+                self._send(client, ('error', repr(e)))
+                continue
+            try:
+                if msg[0] == 'act':
+                    _, model_key, shape, dtype = msg
+                    hash(model_key)
+                    acts.append((client, model_key, tuple(shape), dtype))
+                    continue
+            except Exception as e:
+                self._send(client, ('error', f'Malformed message: {e!r}'))
+                continue
+            self._handle(client, msg)
+
+        by_model: Dict[ModelKey, List[Tuple[_ClientState, ModelKey, Tuple[int, ...], str]]] = {}
+        for act in acts:
+            by_model.setdefault(act[1], []).append(act)
+        for model_key, requests in by_model.items():
+            self._act(model_key, requests)
+
+    def _handle(self, client: _ClientState, msg: tuple) -> None:
+        try:
+            kind = msg[0]
+            if kind == 'hello':
+                _, obs_name, action_name = msg
+                client.obs_buf = _attach(obs_name)
+                client.action_buf = _attach(action_name)
+                self._send(client, ('ok',))
+            elif kind == 'load':
+                _, model_key, spec = msg
+                self.specs[model_key] = spec
+                opp = self._get_opponent(model_key)
+                self._send(client, ('ok', opp.obs_builder, opp.action_parser, opp.obs_builder_key, opp.decision_interval, opp.obs_change_threshold))
+            else:
+                self._send(client, ('error', f'Unknown message {kind!r}'))
+        except Exception as e:
+            self._send(client, ('error', repr(e)))
+
+    def _send(self, client: _ClientState, msg: tuple) -> None:
+        if client.conn.closed:
+            return
+        try:
+            client.conn.send(msg)
+        except (BrokenPipeError, ConnectionResetError, EOFError, OSError):
+            # The env process is gone, which shouldn't affect anyone else
+            self._drop(client)
+
+    def _drop(self, client: _ClientState) -> None:
+        self._clients.pop(client.conn, None)
+        client.close()
+
+    def _get_opponent(self, model_key: ModelKey) -> Opponent:
+        cls, location, location_type, bot_name, run_name = self.specs[model_key]
+        # Reloaded transparently if it was evicted since the client loaded it
+        return self.model_cache.get_or_load(model_key, lambda: cls.load_from_location(location, location_type, bot_name, run_name))
+
+    def _act(self, model_key: ModelKey, requests: List[Tuple[_ClientState, ModelKey, Tuple[int, ...], str]]) -> None:
+        obs = {}
+        valid = []
+        for request in requests:
+            client, _, shape, dtype = request
+            # A request that doesn't fit the client's buffer only fails that client
+            try:
+                rows = np.ndarray(shape, dtype=dtype, buffer=client.obs_buf.buf)
+            except Exception as e:
+                self._send(client, ('error', repr(e)))
+                continue
+            for j in range(shape[0]):
+                obs[(len(valid), j)] = rows[j]
+            valid.append(request)
+        if not valid:
+            return
+        try:
+            actions = self._get_opponent(model_key).act(obs)
+        except Exception as e:
+            for client, *_ in valid:
+                self._send(client, ('error', repr(e)))
+            return
+
+        for i, (client, _, shape, _) in enumerate(valid):
+            # A bad reply for one client, e.g. missing or ragged actions, only fails that client's request
+            try:
+                rows = np.stack([np.asarray(actions[(i, j)]) for j in range(shape[0])])
+                if rows.nbytes > client.action_buf.size:
+                    raise ValueError(f'Actions need {rows.nbytes} bytes, but the action buffer is {client.action_buf.size}')
+                np.ndarray(rows.shape, dtype=rows.dtype, buffer=client.action_buf.buf)[:] = rows
+            except Exception as e:
+                self._send(client, ('error', repr(e)))
+                continue
+            self._send(client, ('ok', rows.shape, rows.dtype.str))
+
+
+class RemoteOpponent(Opponent):
+    """
+    Stands in for an opponent loaded by an InferenceServer. Observations are built and actions are
+    parsed in the env process as usual, only `act` runs remotely.
+
+    Observations must be numeric arrays of the same shape for every agent.
+    """
+    def __init__(self, client: "InferenceClient", model_key: ModelKey, obs_builder: ObsBuilder, action_parser: ActionParser, obs_builder_key: Optional[Hashable]=None,
+                 decision_interval: int=1, obs_change_threshold: Optional[float]=None):
+        self.client = client
+        self.model_key = model_key
+        self._obs_builder = obs_builder
+        self._action_parser = action_parser
+        self._obs_builder_key = obs_builder_key
+        self._decision_interval = decision_interval
+        self._obs_change_threshold = obs_change_threshold
+
+    @property
+    def obs_builder(self) -> ObsBuilder:
+        return self._obs_builder
+
+    @property
+    def action_parser(self) -> ActionParser:
+        return self._action_parser
+
+    @property
+    def obs_builder_key(self) -> Optional[Hashable]:
+        return self._obs_builder_key
+
+    @property
+    def decision_interval(self) -> int:
+        return self._decision_interval
+
+    @property
+    def obs_change_threshold(self) -> Optional[float]:
+        return self._obs_change_threshold
+
+    def act(self, obs: Dict[AgentID, ObsType]) -> Dict[AgentID, ActionType]:
+        keys = list(obs)
+        actions = self.client.act(self.model_key, np.stack([obs[k] for k in keys]))
+        return dict(zip(keys, actions))
+
+    @staticmethod
+    def get_filter() -> Dict[str, Tuple[str, ...]]:
+        # Only ever created by InferenceClient.load, never matched against models
+        return {}
+
+    @classmethod
+    def load_from_location(cls, location: str, location_type: str, bot_name: str, run_name: str):
+        raise NotImplementedError("Remote opponents are loaded with InferenceClient.load")
+
+
+class InferenceClient:
+    """
+    Connection from one env process to an InferenceServer.
+
+    Owns the shared memory buffers for this process: observations are written to one as
+    `obs_dtype`, and actions are read back from the other. The buffers must fit the largest
+    batch of a single opponent, which is rarely more than a handful of agents.
+
+    The connection and buffers are only set up by the first `load`, so clients that never
+    load anything cost nothing.
+    """
+    conn: Optional[Connection] = None
+    obs_buf: Optional[SharedMemory] = None
+    action_buf: Optional[SharedMemory] = None
+
+    def __init__(self, address, authkey: bytes=DEFAULT_AUTHKEY, obs_bytes: int=1 << 20, action_bytes: int=1 << 16, obs_dtype=np.float32, connect_timeout: float=30.):
+        if isinstance(address, str):
+            address = parse_address(address)
+        self.address = address
+        self.authkey = authkey
+        self.obs_bytes = obs_bytes
+        self.action_bytes = action_bytes
+        self.connect_timeout = connect_timeout
+        self.obs_dtype = np.dtype(obs_dtype)
+        # Loads can come from a background refresh thread while the env steps
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        # Called with the lock held
+        if self.conn is not None:
+            return
+        self.conn = self._connect(self.address, self.authkey, self.connect_timeout)
+        self.obs_buf = SharedMemory(create=True, size=self.obs_bytes)
+        self.action_buf = SharedMemory(create=True, size=self.action_bytes)
+        try:
+            self._send_recv(('hello', self.obs_buf.name, self.action_buf.name))
+        except BaseException:
+            self._close_unlocked()
+            raise
+
+    @staticmethod
+    def _connect(address, authkey: bytes, timeout: float) -> Connection:
+        # The server is often started alongside the env processes, so give it time to come up
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return Client(address, authkey=authkey)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def load(self, cls: Type[Opponent], location: str, location_type: str, bot_name: str, run_name: str) -> RemoteOpponent:
+        spec = (cls, location, location_type, bot_name, run_name)
+        # Same key for the same model in every client, so the server shares one copy
+        model_key = (f'{cls.__module__}.{cls.__qualname__}', location, location_type, bot_name, run_name)
+        _, obs_builder, action_parser, *settings = self._request(('load', model_key, spec))
+        return RemoteOpponent(self, model_key, obs_builder, action_parser, *settings)
+
+    def act(self, model_key: ModelKey, obs: np.ndarray) -> np.ndarray:
+        obs = np.ascontiguousarray(obs, dtype=self.obs_dtype)
+        if obs.nbytes > self.obs_bytes:
+            raise ValueError(f'Observations need {obs.nbytes} bytes, but the observation buffer is {self.obs_bytes}')
+        with self._lock:
+            self._open()
+            np.ndarray(obs.shape, dtype=obs.dtype, buffer=self.obs_buf.buf)[:] = obs
+            _, shape, dtype = self._send_recv(('act', model_key, obs.shape, obs.dtype.str))
+            # Copied out, the buffer is reused by the next request
+            return np.ndarray(shape, dtype=dtype, buffer=self.action_buf.buf).copy()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close_unlocked()
+
+    def _close_unlocked(self) -> None:
+        # Safe to call more than once, arenas of a VecRCubed share one client
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        for buf in (self.obs_buf, self.action_buf):
+            if buf is not None:
+                buf.close()
+                buf.unlink()
+        self.obs_buf = self.action_buf = None
+
+    def _request(self, msg: tuple) -> tuple:
+        with self._lock:
+            self._open()
+            return self._send_recv(msg)
+
+    def _send_recv(self, msg: tuple) -> tuple:
+        self.conn.send(msg)
+        reply = self.conn.recv()
+        if reply[0] == 'error':
+            raise RuntimeError(f'Inference server error: {reply[1]}')
+        return reply
+
+
+def spawn_server(address: str, authkey: bytes=DEFAULT_AUTHKEY, max_models: int=32) -> subprocess.Popen:
+    """
+    Starts an InferenceServer in a new process, listening on `address` (host:port or a socket path).
+
+    This runs the module as a script rather than forking, so the server has its own resource
+    tracker and never unlinks shared memory that belongs to the processes that started it.
+    The authkey goes through the environment, where other users can't read it, not the command line.
+    """
+    env = {**os.environ, AUTHKEY_ENV: authkey.decode()}
+    return subprocess.Popen([
+        sys.executable, '-m', 'rcubed.wrapper.inference',
+        '--address', address,
+        '--max-models', str(max_models),
+    ], env=env)
+
+
+def _is_local(address) -> bool:
+    # Unix sockets, and TCP on loopback
+    if not isinstance(address, tuple):
+        return True
+    host = address[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(address: str):
+    # host:port for TCP, anything else is a unix socket path
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
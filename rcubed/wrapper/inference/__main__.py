@@ -0,0 +1,21 @@
+from argparse import ArgumentParser
+import os
+
+from rcubed.wrapper.inference import AUTHKEY_ENV, DEFAULT_AUTHKEY, InferenceServer, parse_address
+
+parser = ArgumentParser(
+    prog='rcubed.wrapper.inference',
+    description='Serves opponent inference to RCubed env processes on this node'
+)
+parser.add_argument('-a', '--address', default='127.0.0.1:5152', help='host:port or unix socket path. Default 127.0.0.1:5152')
+parser.add_argument('--authkey', default=os.environ.get(AUTHKEY_ENV, DEFAULT_AUTHKEY.decode()),
+                    help=f'Shared secret clients must present. Required unless listening on loopback or a unix socket, as the default is public. '
+                         f'Prefer setting {AUTHKEY_ENV}, as arguments are visible to other users in the process list')
+parser.add_argument('--max-models', type=int, default=32, help='Opponents kept loaded at once. Default 32')
+args = parser.parse_args()
+
+try:
+    server = InferenceServer(parse_address(args.address), args.authkey.encode(), args.max_models)
+except ValueError as e:
+    parser.error(str(e))
+server.serve_forever()
@@ -0,0 +1,81 @@
+"""
+Keeps loaded opponents around between refreshes so unchanged models aren't deserialized again
+"""
+from collections import OrderedDict
+import threading
+from typing import Callable, Hashable, Optional
+
+from rcubed.wrapper.opponent import Opponent
+
+
+class ModelCache:
+    """
+    LRU cache of loaded opponents, keyed by model id and location.
+
+    Limits are checked after every insert, and the least recently used models are evicted until
+    both are satisfied. The most recent model is always kept, even if it is over the byte budget
+    on its own. Evicting a model only drops the cache's reference, so opponents still in the pool
+    keep working and are just reloaded the next time they're requested.
+    """
+    def __init__(self, max_models: Optional[int]=32, max_bytes: Optional[int]=None):
+        """
+        :param max_models: Maximum number of models to keep, or None for no limit
+        :param max_bytes: Maximum total `Opponent.nbytes` to keep, or None for no limit
+        """
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._models: "OrderedDict[Hashable, Opponent]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Opponent]) -> Opponent:
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+
+        # Loading happens outside the lock, it's the slow part
+        model = load()
+        with self._lock:
+            if key in self._models:
+                self.nbytes -= self._models[key].nbytes
+            self._models[key] = model
+            self._models.move_to_end(key)
+            self.nbytes += model.nbytes
+            self._evict()
+        return model
+
+    def _evict(self) -> None:
+        while len(self._models) > 1 and (
+            (self.max_models is not None and len(self._models) > self.max_models)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            _, model = self._models.popitem(last=False)
+            self.nbytes -= model.nbytes
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "models": len(self._models),
+            "bytes": self.nbytes,
+        }
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._models
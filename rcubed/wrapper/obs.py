@@ -1,8 +1,10 @@
-from typing import Any, Dict, List
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional
 from rlgym.api import ObsBuilder, AgentID, ObsType, StateType, SpaceType
 
 from rcubed.wrapper.botmanager import BotManager
-from rcubed.wrapper.common import BOT_MANAGER_KEY
+from rcubed.wrapper.common import BOT_MANAGER_KEY, PROFILER_KEY
+from rcubed.wrapper.profiling import StepProfiler
 
 
 class WrappedObs(ObsBuilder[AgentID, ObsType, StateType, SpaceType]):
@@ -11,12 +13,20 @@ class WrappedObs(ObsBuilder[AgentID, ObsType, StateType, SpaceType]):
 
     def build_obs(self, agents: List[AgentID], state: StateType, shared_info: Dict[str, Any]) -> Dict[AgentID, ObsType]:
         obss = {}
-        bot_manager: BotManager = shared_info[BOT_MANAGER_KEY]
-        for opp, ids in bot_manager.inv_mapping.items():
-            subset = opp.obs_builder.build_obs([agent for agent in agents if agent in ids], state, shared_info)
+        partition = shared_info[BOT_MANAGER_KEY].partition
+        profiler: Optional[StepProfiler] = shared_info.get(PROFILER_KEY)
+        # One call per shared builder, timed under the opponent that owns it
+        for opp, ids in partition.obs_groups:
+            t0 = profiler and perf_counter_ns()
+            subset = opp.obs_builder.build_obs(ids, state, shared_info)
+            if profiler is not None:
+                profiler.record_opponent('obs', opp, t0)
             obss.update(subset)
-        
-        default_actions = self.default.build_obs([agent for agent in agents if bot_manager.mapping[agent] is None], state, shared_info)
+
+        t0 = profiler and perf_counter_ns()
+        default_actions = self.default.build_obs(partition.learners, state, shared_info)
+        if profiler is not None:
+            profiler.record('learner_obs', t0)
         obss.update(default_actions)
 
         return obss
@@ -26,7 +36,7 @@ class WrappedObs(ObsBuilder[AgentID, ObsType, StateType, SpaceType]):
     
     def reset(self, initial_state: StateType, shared_info: Dict[str, Any]) -> None:
         bot_manager: BotManager = shared_info[BOT_MANAGER_KEY]
-        for opp in bot_manager.inv_mapping.keys():
+        for opp, _ in bot_manager.partition.obs_groups:
             opp.obs_builder.reset(initial_state, shared_info)
         
         self.default.reset(initial_state, shared_info)
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Tuple
+from typing import Dict, Hashable, Optional, Tuple
 
 from rlgym.api import AgentID, ObsType, ActionType, ActionParser, ObsBuilder
 
@@ -17,6 +17,10 @@ class Opponent(ABC):
     
     @abstractmethod
     def act(self, obs: Dict[AgentID, ObsType]) -> Dict[AgentID, ActionType]:
+        """
+        Returns an action for every key in `obs`. Keys should be treated as opaque,
+        as VecRCubed batches agents from several arenas under (arena, agent) keys.
+        """
         raise NotImplementedError()
 
     @staticmethod
@@ -32,4 +36,38 @@ class Opponent(ABC):
     @abstractmethod
     def load_from_location(cls, location: str, location_type: str, bot_name: str, run_name: str):
         raise NotImplementedError()
-    
\ No newline at end of file
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Approximate memory held by this opponent, used for the byte budget of the model cache.
+        """
+        return 0
+
+    @property
+    def obs_builder_key(self) -> Optional[Hashable]:
+        """
+        Opponents with the same key share one observation builder, so it is built and reset once
+        per step for all of their agents together, using the builder of one of them. Set this when
+        the builder has no per-opponent state, e.g. to the run name for checkpoints of one run.
+        None means the builder is never shared.
+        """
+        return None
+
+    @property
+    def decision_interval(self) -> int:
+        """
+        Env steps between calls to `act` for each of this opponent's agents. In between, the agent's
+        last parsed action is replayed, so neither `act` nor the action parser run for it.
+        Raising this cuts inference roughly by the interval, which is worth it for expensive models.
+        """
+        return 1
+
+    @property
+    def obs_change_threshold(self) -> Optional[float]:
+        """
+        With a decision interval above 1, an agent also decides early once the largest absolute
+        difference between its observation and the one it last decided on exceeds this.
+        None means agents only decide on the interval. Requires numeric array observations.
+        """
+        return None
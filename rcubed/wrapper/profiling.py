@@ -0,0 +1,148 @@
+"""
+Opt-in timing of the phases of an RCubed step, for finding where wall time goes
+"""
+from time import perf_counter_ns
+from typing import Any, Callable, Dict, List
+
+from rlgym.api import TransitionEngine, AgentID, EngineActionType, StateType
+
+from rcubed.wrapper.opponent import Opponent
+
+# Buckets are powers of two in nanoseconds, starting below 2^10 ns (~1us) up to 2^30 ns (~1s) and above
+_MIN_BUCKET_BITS = 10
+_N_BUCKETS = 22
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * _N_BUCKETS
+
+    def record(self, ns: int) -> None:
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[min(max(ns.bit_length() - _MIN_BUCKET_BITS, 0), _N_BUCKETS - 1)] += 1
+
+    def percentile_us(self, p: float) -> float:
+        """
+        Upper bound of the bucket containing the p-th percentile (0-100).
+        """
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n > 0:
+                return min(2 ** (i + _MIN_BUCKET_BITS), self.max_ns) / 1e3
+        return self.max_ns / 1e3
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "total_ms": self.total_ns / 1e6,
+            "mean_us": self.total_ns / self.count / 1e3 if self.count else 0.,
+            "p50_us": self.percentile_us(50),
+            "p90_us": self.percentile_us(90),
+            "p99_us": self.percentile_us(99),
+            "max_us": self.max_ns / 1e3,
+        }
+
+
+class StepProfiler:
+    """
+    Counters and latency histograms for each phase of a step, and for each opponent.
+
+    The wrappers look this up in shared_info under PROFILER_KEY and skip all timing when it
+    isn't there, so profiling costs nothing unless it's enabled.
+
+    Phases are `rlgym_step` (the whole underlying step), `engine`, `learner_obs`, `learner_parse`
+    and `reset`. Each opponent gets `act`, `obs` and `parse`, under the label from `label_fn`.
+    """
+    def __init__(self, label_fn: Callable[[Opponent], str]=lambda opp: f"{type(opp).__name__}@{id(opp):x}"):
+        self.label_fn = label_fn
+        self.phases: Dict[str, LatencyHistogram] = {}
+        self.opponents: Dict[str, Dict[str, LatencyHistogram]] = {}
+
+    def record(self, phase: str, start_ns: int) -> None:
+        elapsed = perf_counter_ns() - start_ns
+        hist = self.phases.get(phase)
+        if hist is None:
+            hist = self.phases[phase] = LatencyHistogram()
+        hist.record(elapsed)
+
+    def record_opponent(self, phase: str, opp: Opponent, start_ns: int) -> None:
+        elapsed = perf_counter_ns() - start_ns
+        phases = self.opponents.setdefault(self.label_fn(opp), {})
+        hist = phases.get(phase)
+        if hist is None:
+            hist = phases[phase] = LatencyHistogram()
+        hist.record(elapsed)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "phases": {phase: hist.summary() for phase, hist in self.phases.items()},
+            "opponents": {
+                label: {phase: hist.summary() for phase, hist in phases.items()}
+                for label, phases in self.opponents.items()
+            },
+        }
+
+    def reset(self) -> None:
+        """
+        Clears all counters, e.g. after logging them for a training iteration.
+        """
+        self.phases.clear()
+        self.opponents.clear()
+
+
+class TimedEngine(TransitionEngine[AgentID, StateType, EngineActionType]):
+    """
+    Forwards to another transition engine, timing its steps under the `engine` phase.
+    """
+    def __init__(self, engine: TransitionEngine, profiler: StepProfiler):
+        self.engine = engine
+        self.profiler = profiler
+
+    @property
+    def agents(self) -> List[AgentID]:
+        return self.engine.agents
+
+    @property
+    def max_num_agents(self) -> int:
+        return self.engine.max_num_agents
+
+    @property
+    def state(self) -> StateType:
+        return self.engine.state
+
+    @property
+    def config(self) -> Dict[str, Any]:
+        return self.engine.config
+
+    @config.setter
+    def config(self, value: Dict[str, Any]):
+        self.engine.config = value
+
+    def step(self, actions: Dict[AgentID, EngineActionType], shared_info: Dict[str, Any]) -> StateType:
+        t0 = perf_counter_ns()
+        state = self.engine.step(actions, shared_info)
+        self.profiler.record('engine', t0)
+        return state
+
+    def create_base_state(self) -> StateType:
+        return self.engine.create_base_state()
+
+    def set_state(self, desired_state: StateType, shared_info: Dict[str, Any]) -> StateType:
+        return self.engine.set_state(desired_state, shared_info)
+
+    def close(self) -> None:
+        self.engine.close()
+
+    def __getattr__(self, name: str):
+        # Anything engine specific (e.g. for renderers) goes straight through
+        if name == 'engine':
+            raise AttributeError(name)
+        return getattr(self.engine, name)
@@ -1,5 +1,6 @@
 from rlgym.api import RLGym
 
+from time import perf_counter_ns
 from typing import Any, List, Dict, Tuple, Generic, Optional, Type
 
 from rlgym.api.config import ActionParser, DoneCondition, ObsBuilder, RewardFunction, StateMutator, Renderer, TransitionEngine
@@ -9,11 +10,16 @@ from rlgym.rocket_league.state_mutators import MutatorSequence
 from rlgym.rocket_league.action_parsers import RepeatAction
 
 from rcubed.wrapper.mutator import WrapperMutator
-from rcubed.wrapper.common import BOT_MANAGER_KEY
+from rcubed.wrapper.common import BOT_MANAGER_KEY, PROFILER_KEY
+from rcubed.wrapper.artifacts import ArtifactCache
+from rcubed.wrapper.arrays import AgentBuffers
 from rcubed.wrapper.botmanager import BotManager
+from rcubed.wrapper.inference import DEFAULT_AUTHKEY, InferenceClient
+from rcubed.wrapper.modelcache import ModelCache
 from rcubed.wrapper.obs import WrappedObs
 from rcubed.wrapper.action import WrappedParser
 from rcubed.wrapper.opponent import Opponent
+from rcubed.wrapper.profiling import StepProfiler, TimedEngine
 
 class RCubed(RLGym[AgentID, ObsType, ActionType, EngineActionType, RewardType, StateType, SpaceType]):
 
@@ -34,6 +40,17 @@ class RCubed(RLGym[AgentID, ObsType, ActionType, EngineActionType, RewardType, S
                  run_name: str=None,
                  opponent_refresh_eps=1e6,
                  opponent_pool_size=5,
+                 opponent_background_refresh=False,
+                 opponent_roll_steps=None,
+                 opponent_roll_size=1,
+                 opponent_cache_size=32,
+                 opponent_cache_bytes=None,
+                 profile=False,
+                 opponent_inference_address=None,
+                 opponent_inference_authkey=DEFAULT_AUTHKEY,
+                 opponent_artifact_dir=None,
+                 opponent_artifact_bytes=None,
+                 array_mode=False,
                  ):
         if isinstance(state_mutator, MutatorSequence):
             wrapped_state_mutator = state_mutator
@@ -46,7 +63,13 @@ class RCubed(RLGym[AgentID, ObsType, ActionType, EngineActionType, RewardType, S
             action_parser.parser = WrappedParser(action_parser.parser)
         else:
             wrapped_action_parser = WrappedParser(action_parser)
-        
+
+        # Only set when profiling, the wrappers skip timing entirely otherwise
+        self.profiler: Optional[StepProfiler] = None
+        if profile:
+            self.profiler = StepProfiler()
+            transition_engine = TimedEngine(transition_engine, self.profiler)
+
         # This can't be super() because we mess with self.agents
         self.rlgym = RLGym(
             state_mutator=wrapped_state_mutator,
@@ -64,45 +87,134 @@ class RCubed(RLGym[AgentID, ObsType, ActionType, EngineActionType, RewardType, S
             base_url=opponent_base_url,
             bot_name=bot_name,
             run_name=run_name,
+            background_refresh=opponent_background_refresh,
+            model_cache=ModelCache(max_models=opponent_cache_size, max_bytes=opponent_cache_bytes),
+            inference_client=opponent_inference_address and InferenceClient(opponent_inference_address, opponent_inference_authkey),
+            artifact_cache=opponent_artifact_dir and ArtifactCache(opponent_artifact_dir, opponent_artifact_bytes),
         )
         self.rlgym.shared_info[BOT_MANAGER_KEY] = self.bot_manager
+        if self.profiler is not None:
+            self.profiler.label_fn = self.bot_manager.opponent_label
+            self.rlgym.shared_info[PROFILER_KEY] = self.profiler
 
         self.managed_obs: Dict[AgentID, ObsType] = None
 
         self.opponent_refresh_eps = opponent_refresh_eps
         self.ep_remaining = 0
         self.opponent_pool_size = opponent_pool_size
+        # Rolling pools replace a few opponents every `opponent_roll_steps` steps instead of all of them per refresh
+        self.opponent_roll_steps = opponent_roll_steps
+        self.opponent_roll_size = opponent_roll_size
+        self.steps_until_roll = opponent_roll_steps
+        # In array mode learners keep one slot per match, and step data goes through preallocated buffers
+        self.array_mode = array_mode
+        self._buffers: Optional[AgentBuffers] = None
 
     def register(self, bot: Type[Opponent]) -> None:
         self.bot_manager.register(bot)
 
     def step(self, actions: Dict[AgentID, ActionType]) -> Tuple[Dict[AgentID, ObsType], Dict[AgentID, RewardType], Dict[AgentID, bool], Dict[AgentID, bool]]:
-        for opp, ids in self.bot_manager.inv_mapping.items():
-            actions.update(opp.act({k:v for k, v in self.managed_obs.items() if k in ids}))
-        step_return = self.rlgym.step(actions)
-        self.managed_obs = {k:v for k, v in step_return[0].items() if self.bot_manager.mapping[k] is not None}
-        return tuple(({k:v for k, v in ret.items() if self.bot_manager.mapping[k] is None} for ret in step_return))
-    
+        """
+        In array mode, `actions` is one row per learner in the order of `agents`, and the returned
+        observations, rewards and done flags are arrays in the same order. They are reused buffers,
+        overwritten by the next step or reset.
+        """
+        actions = self._learner_actions(actions)
+        managed_obs = self.managed_obs
+        profiler = self.profiler
+        bot_manager = self.bot_manager
+        for opp, ids in bot_manager.partition.opponents:
+            ids = bot_manager.deciding_agents(opp, ids, managed_obs)
+            if not ids:
+                continue
+            t0 = profiler and perf_counter_ns()
+            actions.update(opp.act({agent: managed_obs[agent] for agent in ids}))
+            if profiler is not None:
+                profiler.record_opponent('act', opp, t0)
+        if self.opponent_roll_steps:
+            self._count_steps(1)
+        return self._step_arena(actions)
+
+    def _count_steps(self, n: int) -> bool:
+        """
+        Counts steps towards the next roll of the opponent pool, rolling it if one is due.
+        Returns whether it rolled.
+        """
+        self.steps_until_roll -= n
+        if self.steps_until_roll > 0:
+            return False
+        self.steps_until_roll = self.opponent_roll_steps
+        self.bot_manager.roll_opponents(self.opponent_roll_size, self.opponent_pool_size)
+        return True
+
     def reset(self) -> Dict[AgentID, ObsType]:
         self.ep_remaining -= 1
         if self.ep_remaining <= 0:
             self.ep_remaining = self.opponent_refresh_eps
-            self.bot_manager.refresh_opponents()
-        all_obs = self.rlgym.reset()
-        self.managed_obs = {k:v for k, v in all_obs.items() if self.bot_manager.mapping[k] is not None}
-        return {k:v for k, v in all_obs.items() if self.bot_manager.mapping[k] is None}
-    
+            self.bot_manager.refresh_opponents(self.opponent_pool_size)
+        self.bot_manager.swap_opponents()
+        t0 = self.profiler and perf_counter_ns()
+        obs = self._reset_arena()
+        if self.profiler is not None:
+            self.profiler.record('reset', t0)
+        return obs
+
+    def _step_arena(self, actions: Dict[AgentID, ActionType]) -> Tuple[Dict[AgentID, ObsType], Dict[AgentID, RewardType], Dict[AgentID, bool], Dict[AgentID, bool]]:
+        """
+        Steps the underlying arena with actions for every agent (learners and opponents),
+        keeping the opponent observations and returning only the learner's share.
+        """
+        t0 = self.profiler and perf_counter_ns()
+        obs, rewards, terminated, truncated = self.rlgym.step(actions)
+        if self.profiler is not None:
+            self.profiler.record('rlgym_step', t0)
+        if self.array_mode:
+            return (self._split_obs(obs), *self._buffers.write_step(rewards, terminated, truncated))
+        learners = self.bot_manager.partition.learners
+        return (
+            self._split_obs(obs),
+            {agent: rewards[agent] for agent in learners},
+            {agent: terminated[agent] for agent in learners},
+            {agent: truncated[agent] for agent in learners},
+        )
+
+    def _reset_arena(self) -> Dict[AgentID, ObsType]:
+        """
+        Resets the underlying arena using the current opponent pool.
+        """
+        return self._split_obs(self.rlgym.reset())
+
+    def _learner_actions(self, actions: Dict[AgentID, ActionType]) -> Dict[AgentID, ActionType]:
+        if not self.array_mode:
+            return actions
+        return self._buffers.read_actions(actions)
+
+    def _split_obs(self, all_obs: Dict[AgentID, ObsType]) -> Dict[AgentID, ObsType]:
+        # Keeps the opponents' share for the next step and returns the learner's
+        partition = self.bot_manager.partition
+        if self.array_mode:
+            if self._buffers is None or self._buffers.agents != partition.learners:
+                self._buffers = AgentBuffers(partition.learners)
+            # Opponents get the builders' own arrays, and the dict is refilled rather than rebuilt
+            if self.managed_obs is None:
+                self.managed_obs = {}
+            self.managed_obs.clear()
+            self.managed_obs.update((agent, all_obs[agent]) for agent in partition.opponent_agents)
+            return self._buffers.write_obs(all_obs)
+        self.managed_obs = {agent: all_obs[agent] for agent in partition.opponent_agents}
+        return {agent: all_obs[agent] for agent in partition.learners}
+
     @property
     def agents(self) -> List[AgentID]:
-        return [agent for agent in self.rlgym.agents if self.bot_manager.mapping[agent] is None]
+        return list(self.bot_manager.partition.learners)
 
     @property
     def action_spaces(self) -> Dict[AgentID, SpaceType]:
-        return {agent: space for agent, space in self.rlgym.action_spaces.items() if self.bot_manager.mapping[agent] is None}
+        return {agent: self.rlgym.action_space(agent) for agent in self.bot_manager.partition.learners}
 
     @property
     def observation_spaces(self) -> Dict[AgentID, SpaceType]:
-        return {agent: space for agent, space in self.rlgym.observation_spaces.items() if self.bot_manager.mapping[agent] is None}
+        return {agent: self.rlgym.observation_space(agent) for agent in self.bot_manager.partition.learners}
 
     @property
     def state(self) -> StateType:
@@ -115,12 +227,12 @@ class RCubed(RLGym[AgentID, ObsType, ActionType, EngineActionType, RewardType, S
         return self.rlgym.action_space(agent)
 
     def set_state(self, desired_state: StateType) -> Dict[AgentID, ObsType]:
-        all_obs = self.rlgym.set_state(desired_state)
-        self.managed_obs = {k:v for k, v in all_obs.items() if self.bot_manager.mapping[k] is not None}
-        return {k:v for k, v in all_obs.items() if self.bot_manager.mapping[k] is None}
+        return self._split_obs(self.rlgym.set_state(desired_state))
 
     def render(self):
         return self.rlgym.render()
 
     def close(self) -> None:
         self.rlgym.close()
+        if self.bot_manager.inference_client is not None:
+            self.bot_manager.inference_client.close()
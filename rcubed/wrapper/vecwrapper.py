@@ -0,0 +1,131 @@
+"""
+Runs several RCubed arenas side by side so that opponents can act on all of them in one batch
+"""
+from time import perf_counter_ns
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from rlgym.api.typing import AgentID, ObsType, ActionType, RewardType, StateType, SpaceType
+
+from rcubed.wrapper.botmanager import BotManager
+from rcubed.wrapper.opponent import Opponent
+from rcubed.wrapper.v2wrapper import RCubed
+
+# Opponents see observations from every arena at once, keyed by (arena index, agent id)
+BatchedAgentID = Tuple[int, AgentID]
+
+
+class VecRCubed:
+    """
+    Steps N RCubed arenas together. All arenas share one opponent pool, and each loaded
+    opponent gets a single `Opponent.act` call per step covering its agents in every arena.
+
+    Arenas are independent otherwise: `step` and `reset` take and return one entry per arena,
+    and an arena that has terminated or truncated should be reset with `reset(idx)`.
+    """
+    envs: List[RCubed]
+
+    def __init__(self, env_fn: Callable[[], RCubed], n_arenas: int):
+        """
+        :param env_fn: Builds a single RCubed arena. It is called once per arena, so every
+                       arena gets its own transition engine, mutators and builders.
+                       Only the opponent settings of the first arena are used: it loads the
+                       shared pool, and the other arenas use its session, caches and
+                       inference client rather than their own.
+        :param n_arenas: Number of arenas to run
+        """
+        self.envs = [env_fn() for _ in range(n_arenas)]
+        primary = self.envs[0]
+        for env in self.envs[1:]:
+            # Their own inference clients are never used, and so never connect
+            env.bot_manager.share_resources(primary.bot_manager)
+        self.opponent_refresh_eps = primary.opponent_refresh_eps
+        self.opponent_pool_size = primary.opponent_pool_size
+        self.ep_remaining = 0
+
+    @property
+    def bot_manager(self) -> BotManager:
+        # The first arena's manager owns the pool, the others only hold their own match mapping
+        return self.envs[0].bot_manager
+
+    @property
+    def n_arenas(self) -> int:
+        return len(self.envs)
+
+    def register(self, bot: Type[Opponent]) -> None:
+        for env in self.envs:
+            env.register(bot)
+
+    def step(self, actions: List[Dict[AgentID, ActionType]]) -> List[Tuple[Dict[AgentID, ObsType], Dict[AgentID, RewardType], Dict[AgentID, bool], Dict[AgentID, bool]]]:
+        """
+        Takes one dict of learner actions per arena and returns one (obs, rewards, terminated, truncated)
+        tuple per arena. Arenas in array mode take and return arrays instead, as in RCubed.step.
+        """
+        # Arenas in array mode take an array of learner actions
+        actions = [env._learner_actions(arena_actions) for env, arena_actions in zip(self.envs, actions)]
+        batched_obs: Dict[Opponent, Dict[BatchedAgentID, ObsType]] = {}
+        for idx, env in enumerate(self.envs):
+            for opp, ids in env.bot_manager.partition.opponents:
+                ids = env.bot_manager.deciding_agents(opp, ids, env.managed_obs)
+                if not ids:
+                    continue
+                opp_obs = batched_obs.setdefault(opp, {})
+                for agent in ids:
+                    opp_obs[(idx, agent)] = env.managed_obs[agent]
+
+        profiler = self.envs[0].profiler
+        for opp, obs in batched_obs.items():
+            t0 = profiler and perf_counter_ns()
+            opp_actions = opp.act(obs)
+            if profiler is not None:
+                profiler.record_opponent('act', opp, t0)
+            for (idx, agent), action in opp_actions.items():
+                actions[idx][agent] = action
+
+        # Every arena step counts towards the shared roll interval
+        if self.envs[0].opponent_roll_steps and self.envs[0]._count_steps(self.n_arenas):
+            self._sync_pools()
+
+        return [env._step_arena(arena_actions) for env, arena_actions in zip(self.envs, actions)]
+
+    def reset(self, idx: Optional[int]=None):
+        """
+        Resets a single arena if `idx` is given and returns its learner observations,
+        otherwise resets every arena and returns a list of them.
+        """
+        if idx is not None:
+            return self._reset_one(idx)
+        return [self._reset_one(i) for i in range(self.n_arenas)]
+
+    def _reset_one(self, idx: int) -> Dict[AgentID, ObsType]:
+        # Every arena reset counts as an episode towards the shared refresh interval
+        self.ep_remaining -= 1
+        if self.ep_remaining <= 0:
+            self.ep_remaining = self.opponent_refresh_eps
+            self.bot_manager.refresh_opponents(self.opponent_pool_size)
+        self.bot_manager.swap_opponents()
+        self._sync_pools()
+        return self.envs[idx]._reset_arena()
+
+    def _sync_pools(self) -> None:
+        # Arenas still mid-episode keep the opponents they were matched with until their next reset
+        for env in self.envs[1:]:
+            env.bot_manager.loaded_models = self.bot_manager.loaded_models
+
+    def agents(self, idx: int) -> List[AgentID]:
+        return self.envs[idx].agents
+
+    def action_spaces(self, idx: int) -> Dict[AgentID, SpaceType]:
+        return self.envs[idx].action_spaces
+
+    def observation_spaces(self, idx: int) -> Dict[AgentID, SpaceType]:
+        return self.envs[idx].observation_spaces
+
+    def state(self, idx: int) -> StateType:
+        return self.envs[idx].state
+
+    def render(self, idx: int=0):
+        return self.envs[idx].render()
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()